@@ -1,14 +1,22 @@
+import asyncio
+import hashlib
+import heapq
 import json
 import os
 import re
+import secrets
 from dataclasses import dataclass
 from datetime import date, datetime, timedelta, time
+from functools import cache, lru_cache, wraps
 import html
+from bisect import bisect_left
+from collections import OrderedDict
+from itertools import chain
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional
 
 from dotenv import load_dotenv
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, Update
+from telegram import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, Update
 from telegram.constants import ParseMode
 from telegram.ext import (
     Application,
@@ -20,6 +28,16 @@ from telegram.ext import (
 )
 from telegram.request import HTTPXRequest
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import h2
+except ImportError:
+    h2 = None
+
 
 
 DATA_DIR = Path("data")
@@ -43,13 +61,43 @@ HABITS_DEFAULT_CONFIG = [
 
 BACKLOG_TTL_DAYS = 7
 
+SAVE_FLUSH_INTERVAL = 1.0
+# Сколько разобранных состояний держать в памяти (вытесняются давно не активные)
+STATE_CACHE_SIZE = 1024
+# Соединений к Bot API: с concurrent_updates ответы разных пользователей идут параллельно
+BOT_API_POOL_SIZE = 32
+
+# Старые префиксы callback_data, которые ещё могут прийти с давних сообщений
+CALLBACK_ALIASES = {"habit:": "hab:"}
+
+# Разобранные состояния пользователей в порядке обращения; на диск их пишет фоновый флашер
+_state_cache: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+# Сохранённые, но ещё не записанные на диск состояния (уже сериализованные);
+# запись снимается только после того, как файл записан
+_pending_payloads: Dict[int, bytes] = {}
+# Дайджест того, что сейчас лежит в файле: неизменённое состояние не переписываем
+_written_digests: Dict[int, bytes] = {}
+_save_flusher: Optional[asyncio.Task] = None
+_save_flusher_stop: Optional[asyncio.Event] = None
+
+# Апдейты обрабатываются конкурентно; апдейты одного пользователя — по очереди
+_user_locks: Dict[int, asyncio.Lock] = {}
+# Сколько апдейтов держат или ждут замок пользователя; на нуле замок удаляется
+_user_lock_holders: Dict[int, int] = {}
+
+
+@lru_cache(maxsize=4)
+def iso_day(ordinal: int) -> str:
+    return date.fromordinal(ordinal).isoformat()
+
 
 def today_str() -> str:
-    return date.today().isoformat()
+    # Ключ кэша — сам календарный день, поэтому после полуночи значение сразу новое
+    return iso_day(date.today().toordinal())
 
 
 def tomorrow_str() -> str:
-    return (date.today() + timedelta(days=1)).isoformat()
+    return iso_day(date.today().toordinal() + 1)
 
 
 def now_iso() -> str:
@@ -58,6 +106,7 @@ def now_iso() -> str:
 DATE_INPUT_ERROR = "Введите дату в формате ДД.ММ.ГГГГ, например 05.02.2026"
 
 
+@lru_cache(maxsize=4096)
 def format_date_ru(value: str) -> str:
     if not value:
         return value
@@ -70,6 +119,7 @@ def format_date_ru(value: str) -> str:
         return value
 
 
+@lru_cache(maxsize=4096)
 def format_date_ru_short(value: str) -> str:
     if not value:
         return value
@@ -110,22 +160,222 @@ def user_file(user_id: int) -> Path:
 
 
 def load_user_state(user_id: int) -> Dict[str, Any]:
+    # Возвращается живое состояние из кэша, а не свежая копия: любые изменения
+    # сразу видны следующему апдейту. Несохранённые правки упавшего обработчика
+    # откатывает per_user_lock через discard_unsaved_state
+    cached = _state_cache.get(user_id)
+    if cached is not None:
+        _state_cache.move_to_end(user_id)
+        return cached
+    state = read_user_state(user_id)
+    cache_user_state(user_id, state)
+    return state
+
+
+async def warm_user_state(user_id: int) -> None:
+    # Холодное чтение файла уходит в поток, чтобы не держать цикл событий;
+    # дальше синхронный load_user_state в обработчике берёт состояние из кэша
+    if user_id in _state_cache:
+        return
+    raw = await asyncio.to_thread(read_state_file, user_id)
+    if user_id in _state_cache:
+        return
+    cache_user_state(user_id, state_from_file(user_id, raw))
+
+
+def cache_user_state(user_id: int, state: Dict[str, Any]) -> None:
+    _state_cache[user_id] = state
+    trim_state_cache()
+
+
+def trim_state_cache() -> None:
+    # Вытесняем самые давние состояния, но только те, что уже лежат на диске
+    excess = len(_state_cache) - STATE_CACHE_SIZE
+    if excess <= 0:
+        return
+    victims = []
+    for user_id in _state_cache:
+        if len(victims) >= excess:
+            break
+        if user_id not in _pending_payloads:
+            victims.append(user_id)
+    for user_id in victims:
+        del _state_cache[user_id]
+        _written_digests.pop(user_id, None)
+
+
+def read_user_state(user_id: int) -> Dict[str, Any]:
+    return state_from_file(user_id, read_state_file(user_id))
+
+
+def read_state_file(user_id: int) -> Optional[bytes]:
     path = user_file(user_id)
     if not path.exists():
+        return None
+    return path.read_bytes()
+
+
+def state_from_file(user_id: int, raw: Optional[bytes]) -> Dict[str, Any]:
+    if raw is None:
         return {
             "user_id": user_id,
             "created_at": now_iso(),
             "days": {},
             "settings": {"notifications_enabled": True},
         }
-    with path.open("r", encoding="utf-8") as f:
-        return json.load(f)
+    _written_digests[user_id] = payload_digest(raw)
+    return parse_user_state(raw)
 
 
-def save_user_state(user_id: int, state: Dict[str, Any]) -> None:
+def parse_user_state(raw: bytes) -> Dict[str, Any]:
+    state = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    # Режим правки бэклога раньше хранился в файле; теперь он в user_data
+    state.pop("backlog_edit", None)
+    return state
+
+
+def dump_user_state(state: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(state, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(state, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def payload_digest(payload: bytes) -> bytes:
+    return hashlib.blake2b(payload, digest_size=16).digest()
+
+
+def write_state_payload(user_id: int, payload: bytes) -> None:
     path = user_file(user_id)
-    with path.open("w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+    with path.open("wb") as f:
+        f.write(payload)
+
+
+def write_state_payloads(payloads: Dict[int, bytes]) -> None:
+    for user_id, payload in payloads.items():
+        write_state_payload(user_id, payload)
+
+
+def write_user_payload(user_id: int, payload: bytes) -> None:
+    digest = payload_digest(payload)
+    if _written_digests.get(user_id) == digest:
+        return
+    write_state_payload(user_id, payload)
+    _written_digests[user_id] = digest
+
+
+def save_user_state(user_id: int, state: Dict[str, Any]) -> None:
+    # Пока работает флашер, запись откладывается: серия нажатий одного
+    # пользователя превращается в одну запись файла. Снимок берём сразу,
+    # к нему откатываемся, если обработчик упадёт после сохранения.
+    _state_cache[user_id] = state
+    _state_cache.move_to_end(user_id)
+    payload = dump_user_state(state)
+    if _save_flusher is None:
+        write_user_payload(user_id, payload)
+        return
+    _pending_payloads[user_id] = payload
+
+
+def discard_unsaved_state(user_id: int) -> None:
+    # Возвращаемся к последнему сохранённому состоянию: к отложенному снимку
+    # или к файлу, который перечитается при следующем обращении
+    payload = _pending_payloads.get(user_id)
+    if payload is not None:
+        _state_cache[user_id] = parse_user_state(payload)
+    else:
+        _state_cache.pop(user_id, None)
+
+
+def flush_pending_saves() -> None:
+    for user_id, payload in list(_pending_payloads.items()):
+        write_user_payload(user_id, payload)
+        del _pending_payloads[user_id]
+
+
+async def flush_dirty_states() -> None:
+    if not _pending_payloads:
+        return
+    # Файлы пишем пачкой в отдельном потоке; снимки остаются в _pending_payloads,
+    # пока запись не закончится, поэтому такие состояния не вытесняются
+    batch = dict(_pending_payloads)
+    payloads = {}
+    digests = {}
+    for user_id, payload in batch.items():
+        digest = payload_digest(payload)
+        if _written_digests.get(user_id) != digest:
+            payloads[user_id] = payload
+            digests[user_id] = digest
+    if payloads:
+        await asyncio.to_thread(write_state_payloads, payloads)
+        _written_digests.update(digests)
+    for user_id, payload in batch.items():
+        # Пока писали, пользователь мог сохраниться ещё раз — тот снимок оставляем
+        if _pending_payloads.get(user_id) is payload:
+            del _pending_payloads[user_id]
+
+
+async def run_save_flusher(stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=SAVE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await flush_dirty_states()
+        except OSError as e:
+            print(f"Failed to flush user state: {e}")
+
+
+async def start_save_flusher(application: Application) -> None:
+    global _save_flusher, _save_flusher_stop
+    _save_flusher_stop = asyncio.Event()
+    _save_flusher = asyncio.get_running_loop().create_task(run_save_flusher(_save_flusher_stop))
+
+
+async def stop_save_flusher(application: Application) -> None:
+    global _save_flusher, _save_flusher_stop
+    if _save_flusher is not None and _save_flusher_stop is not None:
+        # Останавливаем без cancel, чтобы не оборвать запись, уже ушедшую в поток
+        _save_flusher_stop.set()
+        await _save_flusher
+        _save_flusher = None
+        _save_flusher_stop = None
+    flush_pending_saves()
+
+
+def per_user_lock(
+    handler: Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]
+) -> Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]:
+    @wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.effective_user
+        if user is None:
+            await handler(update, context)
+            return
+        user_id = user.id
+        lock = _user_locks.get(user_id)
+        if lock is None:
+            lock = _user_locks[user_id] = asyncio.Lock()
+        _user_lock_holders[user_id] = _user_lock_holders.get(user_id, 0) + 1
+        try:
+            async with lock:
+                await warm_user_state(user_id)
+                try:
+                    await handler(update, context)
+                except BaseException:
+                    discard_unsaved_state(user_id)
+                    raise
+        finally:
+            # Удаляем замок только когда его никто не ждёт, иначе
+            # новый апдейт получил бы второй замок параллельно с ожидающим
+            remaining = _user_lock_holders[user_id] - 1
+            if remaining:
+                _user_lock_holders[user_id] = remaining
+            else:
+                del _user_lock_holders[user_id]
+                del _user_locks[user_id]
+
+    return wrapper
 
 
 def get_day(state: Dict[str, Any], day: str) -> Dict[str, Any]:
@@ -135,6 +385,14 @@ def get_day(state: Dict[str, Any], day: str) -> Dict[str, Any]:
     return days[day]
 
 
+def peek_day(state: Dict[str, Any], day: str) -> Dict[str, Any]:
+    # Только для просмотра: пустой день не заводим в состоянии, сохранять нечего
+    day_obj = state.get("days", {}).get(day)
+    if day_obj is None:
+        return {"tasks": [], "closed": False}
+    return day_obj
+
+
 def create_default_plan(day_obj: Dict[str, Any]) -> None:
     if day_obj["tasks"]:
         return
@@ -153,25 +411,33 @@ def create_default_plan(day_obj: Dict[str, Any]) -> None:
 
 
 def render_plan(day: str, day_obj: Dict[str, Any], show_hint: bool = False) -> str:
+    # План перерисовывается после каждого нажатия; одинаковые дни берём из кэша
+    closed = bool(day_obj.get("closed"))
+    tasks = () if closed else tuple((t["id"], t["status"] == "done", t["text"]) for t in day_obj.get("tasks", []))
+    return plan_text_for(day, closed, tasks, show_hint)
+
+
+@lru_cache(maxsize=1024)
+def plan_text_for(day: str, closed: bool, tasks: tuple, show_hint: bool) -> str:
     display_day = format_date_ru(day)
     lines = [f"📌 <b>План на {display_day}</b>"]
-    if day_obj.get("closed"):
+    if closed:
         lines.append("⚠️ День закрыт (история).")
         return "\n".join(lines)
 
-    tasks: List[Dict[str, Any]] = day_obj.get("tasks", [])
     if not tasks:
         lines.append("Пока задач нет.")
         return "\n".join(lines)
 
-    for t in tasks:
-        mark = "✅" if t["status"] == "done" else "⬜"
-        lines.append(f"{mark} <b>{t['id']})</b> {t['text']}")
+    for task_id, done, text in tasks:
+        mark = "✅" if done else "⬜"
+        lines.append(f"{mark} <b>{task_id})</b> {text}")
     if show_hint:
         lines.append("\nОтмечай выполненное кнопками ниже.")
     return "\n".join(lines)
 
 
+@cache
 def build_start_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         [
@@ -190,19 +456,25 @@ def build_start_keyboard() -> ReplyKeyboardMarkup:
 def build_today_keyboard(day_obj: Dict[str, Any]) -> InlineKeyboardMarkup:
     if day_obj.get("closed"):
         return InlineKeyboardMarkup([])
-    rows = []
     tasks = day_obj.get("tasks", [])
     todo_tasks = [t for t in tasks if t.get("status") == "todo"]
-    for t in todo_tasks[:10]:
-        task_id = t.get("id")
-        label = f"⬜ {task_id}. {shorten_text(str(t.get('text', '')), 34)}"
+    shown = tuple((t.get("id"), str(t.get("text", ""))) for t in todo_tasks[:10])
+    return today_keyboard_for(shown, len(todo_tasks) > 10)
+
+
+@lru_cache(maxsize=1024)
+def today_keyboard_for(todo: tuple, has_more: bool) -> InlineKeyboardMarkup:
+    rows = []
+    for task_id, text in todo:
+        label = f"⬜ {task_id}. {shorten_text(text, 34)}"
         rows.append([InlineKeyboardButton(label, callback_data=f"done:{task_id}")])
-    if len(todo_tasks) > 10:
+    if has_more:
         rows.append([InlineKeyboardButton("...ещё", callback_data="noop")])
     rows.append([InlineKeyboardButton("📋 Отчёт дня", callback_data="evening")])
     return InlineKeyboardMarkup(rows)
 
 
+@cache
 def build_add_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
@@ -219,6 +491,7 @@ def build_add_keyboard() -> InlineKeyboardMarkup:
     )
 
 
+@cache
 def build_add_today_closed_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
@@ -229,6 +502,7 @@ def build_add_today_closed_keyboard() -> InlineKeyboardMarkup:
     )
 
 
+@cache
 def build_today_closed_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
@@ -249,6 +523,7 @@ def build_backlog_take_keyboard(backlog: List[Dict[str, Any]], limit: int = 5) -
     return InlineKeyboardMarkup(rows)
 
 
+@lru_cache(maxsize=1024)
 def build_pick_to_keyboard(item_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
@@ -259,13 +534,35 @@ def build_pick_to_keyboard(item_id: int) -> InlineKeyboardMarkup:
     )
 
 
-def find_task(day_obj: Dict[str, Any], task_id: int) -> Optional[Dict[str, Any]]:
-    for t in day_obj.get("tasks", []):
+def task_index(tasks: List[Dict[str, Any]], task_id: int) -> Optional[int]:
+    # id задач дня — это их номера 1..N, так что сначала смотрим сразу на место id-1
+    pos = task_id - 1
+    if 0 <= pos < len(tasks) and tasks[pos].get("id") == task_id:
+        return pos
+    for i, t in enumerate(tasks):
         if t.get("id") == task_id:
-            return t
+            return i
     return None
 
 
+def find_task(day_obj: Dict[str, Any], task_id: int) -> Optional[Dict[str, Any]]:
+    tasks = day_obj.get("tasks", [])
+    i = task_index(tasks, task_id)
+    return tasks[i] if i is not None else None
+
+
+def drop_task(day_obj: Dict[str, Any], task_id: int) -> Optional[Dict[str, Any]]:
+    # Удаляем задачу по месту и сдвигаем номера только у тех, что шли после неё
+    tasks = day_obj.get("tasks", [])
+    i = task_index(tasks, task_id)
+    if i is None:
+        return None
+    task = tasks.pop(i)
+    for pos in range(i, len(tasks)):
+        tasks[pos]["id"] = pos + 1
+    return task
+
+
 def normalize_task_ids(tasks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     # Перенумеруем id 1..N, чтобы всё было аккуратно
     new_tasks = []
@@ -276,31 +573,31 @@ def normalize_task_ids(tasks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     return new_tasks
 
 
-def normalize_task_ids_backlog(backlog: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    new_backlog = []
-    for i, item in enumerate(backlog, start=1):
-        item = dict(item)
-        item["id"] = i
-        new_backlog.append(item)
-    return new_backlog
+def append_task(day_obj: Dict[str, Any], task: Dict[str, Any]) -> None:
+    # Новая задача встаёт в конец с номером N+1; копировать список при перенумерации
+    # нужно, только если номера уже сбиты (например, в старых файлах)
+    tasks = day_obj.get("tasks", [])
+    if any(t.get("id") != i for i, t in enumerate(tasks, start=1)):
+        tasks = normalize_task_ids(tasks)
+    tasks.append({"id": len(tasks) + 1, **task})
+    day_obj["tasks"] = tasks
 
 
 def ensure_min_tasks(day_obj: Dict[str, Any], min_count: int = 3) -> None:
     tasks = day_obj.get("tasks", [])
     existing_texts = {t["text"] for t in tasks}
     add_texts = [t for t in DEFAULT_TASKS if t not in existing_texts]
-    while len(tasks) < min_count and add_texts:
+    while len(day_obj.get("tasks", [])) < min_count and add_texts:
         text = add_texts.pop(0)
-        tasks.append(
+        append_task(
+            day_obj,
             {
-                "id": len(tasks) + 1,
                 "text": text,
                 "status": "todo",
                 "created_at": now_iso(),
                 "done_at": None,
-            }
+            },
         )
-    day_obj["tasks"] = normalize_task_ids(tasks)
 
 
 def get_backlog(state: Dict[str, Any]) -> List[Dict[str, Any]]:
@@ -313,20 +610,28 @@ def get_backlog(state: Dict[str, Any]) -> List[Dict[str, Any]]:
 
 def add_task_to_day(state: Dict[str, Any], day: str, text: str) -> Dict[str, Any]:
     day_obj = get_day(state, day)
-    tasks = day_obj.get("tasks", [])
-    tasks.append(
+    append_task(
+        day_obj,
         {
-            "id": len(tasks) + 1,
             "text": text,
             "status": "todo",
             "created_at": now_iso(),
             "done_at": None,
-        }
+        },
     )
-    day_obj["tasks"] = normalize_task_ids(tasks)
     return day_obj
 
 
+@lru_cache(maxsize=1024)
+def parse_iso_date(value: Optional[str]) -> Optional[date]:
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        return None
+
+
 def parse_iso(dt_str: str) -> Optional[datetime]:
     try:
         return datetime.fromisoformat(dt_str)
@@ -356,16 +661,49 @@ def next_backlog_id(backlog: List[Dict[str, Any]]) -> int:
     return max_id + 1
 
 
-def find_backlog_item(backlog: List[Dict[str, Any]], item_id: int) -> Optional[Dict[str, Any]]:
-    for item in backlog:
+def backlog_index(backlog: List[Dict[str, Any]], item_id: int) -> Optional[int]:
+    # Новые задачи получают max(id)+1 и встают в конец, так что бэклог отсортирован
+    # по id и искать можно двоичным поиском; на битых данных — обычный проход
+    try:
+        i = bisect_left(backlog, item_id, key=lambda item: int(item.get("id", 0)))
+        if i < len(backlog) and int(backlog[i].get("id", 0)) == item_id:
+            return i
+    except (TypeError, ValueError):
+        pass
+    for i, item in enumerate(backlog):
         try:
             if int(item.get("id", 0)) == item_id:
-                return item
+                return i
         except Exception:
             continue
     return None
 
 
+def find_backlog_item(backlog: List[Dict[str, Any]], item_id: int) -> Optional[Dict[str, Any]]:
+    i = backlog_index(backlog, item_id)
+    return backlog[i] if i is not None else None
+
+
+def drop_backlog_item(backlog: List[Dict[str, Any]], item: Dict[str, Any]) -> None:
+    # id в бэклоге стабильные: удаляем без перенумерации, номера считаются при показе
+    try:
+        i = backlog_index(backlog, int(item.get("id", 0)))
+    except (TypeError, ValueError):
+        i = None
+    if i is not None and backlog[i] is item:
+        del backlog[i]
+        return
+    for i, other in enumerate(backlog):
+        if other is item:
+            del backlog[i]
+            return
+
+
+def backlog_positions(backlog: List[Dict[str, Any]]) -> Dict[int, int]:
+    # Порядковые номера для показа: позиция в бэклоге по объекту задачи
+    return {id(item): pos for pos, item in enumerate(backlog, start=1)}
+
+
 def find_backlog_by_text(backlog: List[Dict[str, Any]], text: str) -> Optional[Dict[str, Any]]:
     for item in backlog:
         if item.get("text") == text:
@@ -381,28 +719,26 @@ def maybe_pull_from_backlog(state: Dict[str, Any], day_obj: Dict[str, Any]) -> O
     candidates = [item for item in backlog if item.get("source_day")]
     if not candidates:
         return None
-    oldest = sorted(candidates, key=backlog_sort_key)[0]
+    oldest = min(candidates, key=backlog_sort_key)
     oldest["last_seen_at"] = now_iso()
 
     tasks = day_obj.get("tasks", [])
-    task_texts = {t.get("text") for t in tasks}
-    if oldest.get("text") in task_texts:
+    text = oldest.get("text")
+    if any(t.get("text") == text for t in tasks):
         return None
 
-    backlog.remove(oldest)
-    backlog[:] = normalize_task_ids_backlog(backlog)
-    tasks.append(
+    drop_backlog_item(backlog, oldest)
+    append_task(
+        day_obj,
         {
-            "id": len(tasks) + 1,
             "text": oldest.get("text"),
             "status": "todo",
             "created_at": oldest.get("created_at", now_iso()),
             "done_at": None,
             "carried_from": oldest.get("source_day"),
             "carry_count": int(oldest.get("carry_count", 0) or 0),
-        }
+        },
     )
-    day_obj["tasks"] = normalize_task_ids(tasks)
     return oldest
 
 
@@ -412,18 +748,18 @@ def render_backlog(backlog: List[Dict[str, Any]]) -> str:
 
     lines = [f"📦 <b>Бэклог</b> ({len(backlog)} задач)"]
     lines.append("")
-    for item in backlog[:20]:
-        lines.append(f"{item.get('id')}) {item.get('text')}")
+    for pos, item in enumerate(backlog[:20], start=1):
+        lines.append(f"{pos}) {item.get('text')}")
     return "\n".join(lines)
 
 
 def render_backlog_tail(backlog: List[Dict[str, Any]], limit: int = 3) -> str:
     if not backlog:
         return "📦 Бэклог пуст."
-    items = backlog[-limit:]
+    start = max(len(backlog) - limit, 0)
     lines = ["Последние задачи:"]
-    for item in items:
-        lines.append(f"{item.get('id')}) {item.get('text')}")
+    for pos, item in enumerate(backlog[start:], start=start + 1):
+        lines.append(f"{pos}) {item.get('text')}")
     return "\n".join(lines)
 
 
@@ -446,19 +782,22 @@ def parse_task_ids_input(text: str) -> Optional[List[int]]:
 
 def build_delete_day_keyboard(state: Dict[str, Any], active_day: Optional[str]) -> InlineKeyboardMarkup:
     days = state.get("days", {})
-    days_with_tasks = [d for d, obj in days.items() if obj.get("tasks")]
+    days_with_tasks = tuple(sorted((d for d, obj in days.items() if obj.get("tasks")), reverse=True))
     if not days_with_tasks:
-        return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="cancel")]])
+        return build_cancel_keyboard()
+    return delete_day_keyboard_for(days_with_tasks, active_day, today_str())
 
+
+@lru_cache(maxsize=1024)
+def delete_day_keyboard_for(days_with_tasks: tuple, active_day: Optional[str], today: str) -> InlineKeyboardMarkup:
     rows = []
-    days_sorted = sorted(days_with_tasks, reverse=True)
+    days_sorted = list(days_with_tasks)
     if active_day and active_day in days_sorted:
         rows.append(
             [InlineKeyboardButton(f"Текущая: {format_date_ru(active_day)}", callback_data=f"del_pick_day:{active_day}")]
         )
         days_sorted.remove(active_day)
 
-    today = today_str()
     tomorrow = tomorrow_str()
     if today in days_sorted:
         rows.append([InlineKeyboardButton("Сегодня", callback_data=f"del_pick_day:{today}")])
@@ -475,10 +814,16 @@ def build_delete_day_keyboard(state: Dict[str, Any], active_day: Optional[str])
 
 
 def build_delete_tasks_keyboard(day: str, day_obj: Dict[str, Any]) -> InlineKeyboardMarkup:
+    tasks = tuple((t.get("id"), str(t.get("text", ""))) for t in day_obj.get("tasks", []))
+    return delete_tasks_keyboard_for(day, tasks)
+
+
+@lru_cache(maxsize=1024)
+def delete_tasks_keyboard_for(day: str, tasks: tuple) -> InlineKeyboardMarkup:
     rows = []
-    for task in day_obj.get("tasks", []):
-        label = f"🗑 {task.get('id')}) {shorten_text(str(task.get('text', '')), 32)}"
-        rows.append([InlineKeyboardButton(label, callback_data=f"del_one:{day}:{task.get('id')}")])
+    for task_id, text in tasks:
+        label = f"🗑 {task_id}) {shorten_text(text, 32)}"
+        rows.append([InlineKeyboardButton(label, callback_data=f"del_one:{day}:{task_id}")])
     rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="del_back")])
     rows.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel")])
     return InlineKeyboardMarkup(rows)
@@ -492,22 +837,29 @@ def render_triage_list(backlog: List[Dict[str, Any]], limit: int = 3) -> str:
     if not backlog:
         return "📦 Бэклог пуст."
     items = get_triage_items(backlog, limit)
+    positions = backlog_positions(backlog)
     lines = ["🧹 Разобрать бэклог:"]
     for item in items:
-        lines.append(f"{item.get('id')}) {item.get('text')}")
+        lines.append(f"{positions[id(item)]}) {item.get('text')}")
     return "\n".join(lines)
 
 
 def build_triage_keyboard(backlog: List[Dict[str, Any]], limit: int = 3) -> InlineKeyboardMarkup:
+    items = tuple((item.get("id"), str(item.get("text", ""))) for item in get_triage_items(backlog, limit))
+    return triage_keyboard_for(items)
+
+
+@lru_cache(maxsize=1024)
+def triage_keyboard_for(items: tuple) -> InlineKeyboardMarkup:
     rows = []
-    items = get_triage_items(backlog, limit)
-    for item in items:
-        label = shorten_text(str(item.get("text", "")), 34)
-        rows.append([InlineKeyboardButton(label, callback_data=f"triage:{item.get('id')}")])
+    for item_id, text in items:
+        label = shorten_text(text, 34)
+        rows.append([InlineKeyboardButton(label, callback_data=f"triage:{item_id}")])
     rows.append([InlineKeyboardButton("❌ Отмена", callback_data="triage:cancel")])
     return InlineKeyboardMarkup(rows)
 
 
+@lru_cache(maxsize=1024)
 def build_triage_to_keyboard(item_id: int, include_today: bool = True) -> InlineKeyboardMarkup:
     rows = []
     if include_today:
@@ -536,27 +888,33 @@ def backlog_item_date_label(item: Dict[str, Any]) -> str:
 def render_backlog_pick_list(backlog: List[Dict[str, Any]], limit: int = 10) -> str:
     if not backlog:
         return "📦 Бэклог пуст."
-    items = backlog[-limit:]
+    start = max(len(backlog) - limit, 0)
     lines = [f"📦 <b>Бэклог</b> ({len(backlog)} задач)"]
     lines.append("")
-    for item in items:
+    for pos, item in enumerate(backlog[start:], start=start + 1):
         date_tag = backlog_item_date_label(item)
-        lines.append(f"{item.get('id')}) {item.get('text')} [{date_tag}]")
+        lines.append(f"{pos}) {item.get('text')} [{date_tag}]")
     return "\n".join(lines)
 
 
 def build_backlog_pick_keyboard(backlog: List[Dict[str, Any]], limit: int = 10) -> InlineKeyboardMarkup:
+    items = tuple(
+        (item.get("id"), str(item.get("text", "")), backlog_item_date_label(item)) for item in backlog[-limit:]
+    )
+    return backlog_pick_keyboard_for(items)
+
+
+@lru_cache(maxsize=1024)
+def backlog_pick_keyboard_for(items: tuple) -> InlineKeyboardMarkup:
     rows = []
-    items = backlog[-limit:]
-    for item in items:
-        item_id = item.get("id")
-        date_tag = backlog_item_date_label(item)
-        label = f"{shorten_text(str(item.get('text', '')), 24)} [{date_tag}]"
+    for item_id, text, date_tag in items:
+        label = f"{shorten_text(text, 24)} [{date_tag}]"
         rows.append([InlineKeyboardButton(label, callback_data=f"pick:{item_id}")])
     rows.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel")])
     return InlineKeyboardMarkup(rows)
 
 
+@lru_cache(maxsize=1024)
 def build_move_keyboard(item_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
@@ -570,10 +928,12 @@ def build_move_keyboard(item_id: int) -> InlineKeyboardMarkup:
     )
 
 
+@cache
 def build_cancel_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="cancel")]])
 
 
+@cache
 def build_date_mode_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
@@ -585,6 +945,11 @@ def build_date_mode_keyboard() -> InlineKeyboardMarkup:
 
 
 def build_date_list_keyboard(dates: List[str]) -> InlineKeyboardMarkup:
+    return date_list_keyboard_for(tuple(dates))
+
+
+@lru_cache(maxsize=1024)
+def date_list_keyboard_for(dates: tuple) -> InlineKeyboardMarkup:
     rows = []
     for iso in dates:
         rows.append([InlineKeyboardButton(format_date_ru(iso), callback_data=f"date:open:{iso}")])
@@ -592,31 +957,50 @@ def build_date_list_keyboard(dates: List[str]) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 
+# Ключи user_data, которые сбрасываются при выходе из любого режима ввода
+INPUT_MODE_KEYS = (
+    "del_mode",
+    "awaiting_del_id",
+    "del_day",
+    "add_mode",
+    "add_date",
+    "awaiting_task_text",
+    "move_mode",
+    "move_task_id",
+    "view_date_mode",
+    "pending_add_text",
+    "take_mode",
+    "triage_mode",
+    "triage_date_mode",
+    "triage_task_id",
+    "backlog_edit",
+    "view_scope",
+    "view_day",
+    "active_day",
+    "awaiting_habit_title",
+    "habits_selected_date",
+    "habits_selected_day",
+    "habits_week_start",
+    "habits_screen",
+    "feedback_mode",
+    "feedback_text",
+)
+ADD_MODE_KEYS = ("add_mode", "add_date", "awaiting_task_text")
+
+
+def pop_user_data(context: ContextTypes.DEFAULT_TYPE, keys: tuple) -> None:
+    user_data = context.user_data
+    for key in keys:
+        user_data.pop(key, None)
+
+
+def show_day_view(context: ContextTypes.DEFAULT_TYPE, day: str) -> None:
+    # Пользователь смотрит на план дня: от него зависят удаление задач и отметки «готово»
+    context.user_data.update(view_scope="day", view_day=day, active_day=day)
+
+
 def reset_input_modes(context: ContextTypes.DEFAULT_TYPE) -> None:
-    context.user_data.pop("del_mode", None)
-    context.user_data.pop("awaiting_del_id", None)
-    context.user_data.pop("del_day", None)
-    context.user_data.pop("add_mode", None)
-    context.user_data.pop("add_date", None)
-    context.user_data.pop("awaiting_task_text", None)
-    context.user_data.pop("move_mode", None)
-    context.user_data.pop("move_task_id", None)
-    context.user_data.pop("view_date_mode", None)
-    context.user_data.pop("pending_add_text", None)
-    context.user_data.pop("take_mode", None)
-    context.user_data.pop("triage_mode", None)
-    context.user_data.pop("triage_date_mode", None)
-    context.user_data.pop("triage_task_id", None)
-    context.user_data.pop("view_scope", None)
-    context.user_data.pop("view_day", None)
-    context.user_data.pop("active_day", None)
-    context.user_data.pop("awaiting_habit_title", None)
-    context.user_data.pop("habits_selected_date", None)
-    context.user_data.pop("habits_selected_day", None)
-    context.user_data.pop("habits_week_start", None)
-    context.user_data.pop("habits_screen", None)
-    context.user_data.pop("feedback_mode", None)
-    context.user_data.pop("feedback_text", None)
+    pop_user_data(context, INPUT_MODE_KEYS)
 
 
 def render_day_preview(
@@ -726,6 +1110,7 @@ def habit_next_value(value: Any) -> Any:
     return "done" if next_state == "done" else "skip"
 
 
+@lru_cache(maxsize=1024)
 def week_start_for(day: date) -> date:
     return day - timedelta(days=day.weekday())
 
@@ -735,7 +1120,13 @@ def week_dates_for(start: date) -> List[date]:
 
 
 def render_habits_week(state: Dict[str, Any], week_start: date, selected_date: date) -> str:
-    config = get_habits_config(state)
+    # Текст недели зависит только от дат и названий привычек, лог рисует клавиатура
+    titles = tuple(str(habit.get("title", "")) for habit in get_habits_config(state))
+    return habits_week_text_for(week_start, selected_date, titles)
+
+
+@lru_cache(maxsize=1024)
+def habits_week_text_for(week_start: date, selected_date: date, titles: tuple) -> str:
     week_dates = week_dates_for(week_start)
     start_iso = week_dates[0].isoformat()
     end_iso = week_dates[-1].isoformat()
@@ -750,25 +1141,33 @@ def render_habits_week(state: Dict[str, Any], week_start: date, selected_date: d
         f" | выбран: {selected_label.capitalize()}"
     )
     lines = [html.escape(header_line), ""]
-    for i, habit in enumerate(config, start=1):
-        title = html.escape(sanitize_habit_name(str(habit.get("title", ""))))
-        lines.append(f"{i}) {title}")
+    for i, title in enumerate(titles, start=1):
+        lines.append(f"{i}) {html.escape(sanitize_habit_name(title))}")
     return "\n".join(lines)
 
 
 def build_habits_keyboard(state: Dict[str, Any], week_start: date) -> InlineKeyboardMarkup:
     config = get_habits_config(state)
     log = get_habits_log(state)
-    week_dates = week_dates_for(week_start)
-    day_labels = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
-    rows = []
+    week_isos = tuple(d.isoformat() for d in week_dates_for(week_start))
+    day_logs = []
+    for iso in week_isos:
+        day_log = log.get(iso)
+        day_logs.append(day_log if isinstance(day_log, dict) else {})
+    marks = []
     for habit in config:
         key = str(habit.get("key", ""))
+        marks.append((key, tuple(habit_mark(day_log.get(key)) for day_log in day_logs)))
+    return habits_keyboard_for(week_isos, tuple(marks))
+
+
+@lru_cache(maxsize=1024)
+def habits_keyboard_for(week_isos: tuple, marks: tuple) -> InlineKeyboardMarkup:
+    day_labels = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+    rows = []
+    for key, habit_marks in marks:
         row = []
-        for label, day_date in zip(day_labels, week_dates):
-            iso = day_date.isoformat()
-            day_log = log.get(iso, {}) if isinstance(log.get(iso, {}), dict) else {}
-            mark = habit_mark(day_log.get(key))
+        for label, iso, mark in zip(day_labels, week_isos, habit_marks):
             row.append(InlineKeyboardButton(f"{label} {mark}", callback_data=f"hab:toggle:{key}:{iso}"))
         rows.append(row)
     rows.append(
@@ -781,6 +1180,11 @@ def build_habits_keyboard(state: Dict[str, Any], week_start: date) -> InlineKeyb
 
 
 def build_habits_settings_keyboard(week_start: date, selected_date: date) -> InlineKeyboardMarkup:
+    return habits_settings_keyboard()
+
+
+@cache
+def habits_settings_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
             [InlineKeyboardButton("📅 Выбрать день/неделю", callback_data="hab:pick_day")],
@@ -806,7 +1210,11 @@ def build_habits_delete_keyboard(config: List[Dict[str, str]]) -> InlineKeyboard
 
 
 def build_habits_day_picker_keyboard(week_start: date) -> InlineKeyboardMarkup:
-    week_dates = week_dates_for(week_start)
+    return habits_day_picker_keyboard()
+
+
+@cache
+def habits_day_picker_keyboard() -> InlineKeyboardMarkup:
     day_labels = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
     day_codes = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
     buttons = []
@@ -868,8 +1276,12 @@ def notifications_enabled(state: Dict[str, Any]) -> bool:
 
 
 def build_notifications_keyboard(state: Dict[str, Any]) -> InlineKeyboardMarkup:
-    cfg = get_notifications(state)
-    enabled = notifications_enabled(state)
+    get_notifications(state)
+    return notifications_keyboard_for(notifications_enabled(state))
+
+
+@lru_cache(maxsize=2)
+def notifications_keyboard_for(enabled: bool) -> InlineKeyboardMarkup:
     toggle_label = "❌ Выключить" if enabled else "✅ Включить"
     return InlineKeyboardMarkup(
         [
@@ -1071,7 +1483,8 @@ def habits_week_stats(state: Dict[str, Any], week_start: date) -> tuple[int, int
     skip_count = 0
     none_count = 0
     for d in week_dates_for(week_start):
-        day_log = log.get(d.isoformat(), {}) if isinstance(log.get(d.isoformat(), {}), dict) else {}
+        raw = log.get(d.isoformat())
+        day_log = raw if isinstance(raw, dict) else {}
         for habit in config:
             key = str(habit.get("key", ""))
             state_val = habit_state(day_log.get(key))
@@ -1084,19 +1497,24 @@ def habits_week_stats(state: Dict[str, Any], week_start: date) -> tuple[int, int
     return done_count, skip_count, none_count
 
 
-def render_overdue_backlog(items: List[Dict[str, Any]]) -> str:
+def render_overdue_backlog(backlog: List[Dict[str, Any]], items: List[Dict[str, Any]]) -> str:
+    positions = backlog_positions(backlog)
     lines = ["⚠️ <b>Просроченные задачи в бэклоге</b>"]
     for item in items:
         created_at = format_date_ru(str(item.get("created_at", "")))
-        lines.append(f"<b>{item.get('id')})</b> {item.get('text')} ({created_at})")
+        lines.append(f"<b>{positions[id(item)]})</b> {item.get('text')} ({created_at})")
     lines.append("\nВыбери действие:")
     return "\n".join(lines)
 
 
 def build_overdue_keyboard(items: List[Dict[str, Any]]) -> InlineKeyboardMarkup:
+    return overdue_keyboard_for(tuple(item.get("id") for item in items))
+
+
+@lru_cache(maxsize=1024)
+def overdue_keyboard_for(item_ids: tuple) -> InlineKeyboardMarkup:
     rows = []
-    for item in items:
-        item_id = item.get("id")
+    for item_id in item_ids:
         rows.append(
             [
                 InlineKeyboardButton("✂️ Сжать формулировку", callback_data=f"backlog:shorten:{item_id}"),
@@ -1123,6 +1541,68 @@ def apply_done(day_obj: Dict[str, Any], task_id: int) -> tuple[bool, str]:
     return True, f"✅ Отметил: {task_id}) {task['text']}"
 
 
+def evening_header_lines(day: str, done_tasks: List[Dict[str, Any]], total: int) -> Iterator[str]:
+    yield f"📋 <b>Отчёт дня {format_date_ru(day)}</b>"
+    yield f"Сделано: <b>{len(done_tasks)}</b> / <b>{total}</b>"
+    yield ""
+    if not done_tasks:
+        yield "<b>✅ Выполнено:</b> —"
+        return
+    yield "<b>✅ Выполнено:</b>"
+    for t in done_tasks:
+        yield f"✅ {t['id']}) {t['text']}"
+
+
+def evening_carry_lines(carry_report: List[Dict[str, Any]], has_backlog_items: bool) -> Iterator[str]:
+    yield ""
+    if carry_report:
+        yield "<b>⬜ Не сделано (перенёс на завтра):</b>"
+        for t in carry_report:
+            yield f"⬜ {t['id']}) {t['text']}"
+    elif has_backlog_items:
+        yield "<b>⬜ Не сделано (перенёс на завтра):</b> —"
+    else:
+        yield "<b>⬜ Не сделано:</b> —"
+
+
+def evening_backlog_lines(backlog_items: List[Dict[str, Any]]) -> Iterator[str]:
+    if not backlog_items:
+        return
+    yield ""
+    yield "<b>🗂 В бэклог:</b>"
+    for t in backlog_items:
+        yield f"🗂 {t.get('text')}"
+
+
+def evening_tomorrow_lines(tmr: str, tasks: List[Dict[str, Any]]) -> Iterator[str]:
+    yield ""
+    yield f"📌 <b>Черновик на завтра ({format_date_ru(tmr)}):</b>"
+    for t in tasks:
+        yield f"⬜ <b>{t['id']})</b> {t['text']}"
+
+
+def evening_habits_lines(state: Dict[str, Any], day: str) -> Iterator[str]:
+    habits_config = get_habits_config(state)
+    habits_log = get_habits_log(state)
+    raw = habits_log.get(day)
+    day_log = raw if isinstance(raw, dict) else {}
+    done_count = 0
+    skip_count = 0
+    yield ""
+    yield "✅ <b>Привычки за сегодня:</b>"
+    for habit in habits_config:
+        key = str(habit.get("key", ""))
+        title = str(habit.get("title", ""))
+        state_val = habit_state(day_log.get(key))
+        if state_val == "done":
+            done_count += 1
+            yield f"🟩 {title}"
+        elif state_val == "skip":
+            skip_count += 1
+            yield f"🟥 {title}"
+    yield f"Привычки: 🟩 {done_count}, 🟥 {skip_count}"
+
+
 def build_evening_report(state: Dict[str, Any], day: str, day_obj: Dict[str, Any]) -> str:
     tasks: List[Dict[str, Any]] = day_obj.get("tasks", [])
     if not tasks:
@@ -1149,24 +1629,25 @@ def build_evening_report(state: Dict[str, Any], day: str, day_obj: Dict[str, Any
     carry_report = []
     backlog_items = []
     for t in todo_tasks:
+        text = t.get("text")
         carry_count = int(t.get("carry_count", 0) or 0) + 1
         if carry_count >= 3:
-            if t.get("text") in existing_backlog_texts:
-                existing = find_backlog_by_text(backlog, t.get("text"))
+            if text in existing_backlog_texts:
+                existing = find_backlog_by_text(backlog, text)
                 if existing:
                     existing["carry_count"] = max(int(existing.get("carry_count", 0) or 0), carry_count)
                     existing["last_seen_at"] = now_iso()
             else:
                 item = {
                     "id": next_backlog_id(backlog),
-                    "text": t.get("text"),
+                    "text": text,
                     "created_at": now_iso(),
                     "source_day": day,
                     "last_seen_at": now_iso(),
                     "carry_count": carry_count,
                 }
                 backlog.append(item)
-                existing_backlog_texts.add(t.get("text"))
+                existing_backlog_texts.add(text)
                 backlog_items.append(item)
             continue
 
@@ -1183,7 +1664,7 @@ def build_evening_report(state: Dict[str, Any], day: str, day_obj: Dict[str, Any
         )
         carry_report.append(t)
 
-    state["backlog"] = normalize_task_ids_backlog(backlog)
+    state["backlog"] = backlog
 
     # Добавляем перенесённые в начало завтрашних задач (без дублей по тексту)
     existing_texts = {t["text"] for t in tomorrow_obj.get("tasks", [])}
@@ -1192,60 +1673,22 @@ def build_evening_report(state: Dict[str, Any], day: str, day_obj: Dict[str, Any
         if t["text"] not in existing_texts:
             new_tasks.append(t)
 
-    tomorrow_obj["tasks"] = new_tasks + tomorrow_obj.get("tasks", [])
-    tomorrow_obj["tasks"] = normalize_task_ids(tomorrow_obj["tasks"])
+    merged = [*new_tasks, *tomorrow_obj.get("tasks", [])]
+    for i, t in enumerate(merged, start=1):
+        t["id"] = i
+    tomorrow_obj["tasks"] = merged
     ensure_min_tasks(tomorrow_obj, min_count=3)
 
     # Ответ
-    lines = [
-        f"📋 <b>Отчёт дня {format_date_ru(day)}</b>",
-        f"Сделано: <b>{len(done_tasks)}</b> / <b>{len(tasks)}</b>",
-        "",
-        "<b>✅ Выполнено:</b>" if done_tasks else "<b>✅ Выполнено:</b> —",
-    ]
-    if done_tasks:
-        for t in done_tasks:
-            lines.append(f"✅ {t['id']}) {t['text']}")
-
-    if carry_report:
-        lines += ["", "<b>⬜ Не сделано (перенёс на завтра):</b>"]
-        for t in carry_report:
-            lines.append(f"⬜ {t['id']}) {t['text']}")
-    elif backlog_items:
-        lines += ["", "<b>⬜ Не сделано (перенёс на завтра):</b> —"]
-    else:
-        lines += ["", "<b>⬜ Не сделано:</b> —"]
-
-    if backlog_items:
-        lines += ["", "<b>🗂 В бэклог:</b>"]
-        for t in backlog_items:
-            lines.append(f"🗂 {t.get('text')}")
-
-    lines += ["", f"📌 <b>Черновик на завтра ({format_date_ru(tmr)}):</b>"]
-    for t in tomorrow_obj["tasks"]:
-        lines.append(f"⬜ <b>{t['id']})</b> {t['text']}")
-
-    # Привычки за сегодня
-    habits_config = get_habits_config(state)
-    habits_log = get_habits_log(state)
-    day_log = habits_log.get(day, {}) if isinstance(habits_log.get(day, {}), dict) else {}
-    done_count = 0
-    skip_count = 0
-    lines += ["", "✅ <b>Привычки за сегодня:</b>"]
-    for habit in habits_config:
-        key = str(habit.get("key", ""))
-        title = str(habit.get("title", ""))
-        state_val = habit_state(day_log.get(key))
-        if state_val == "done":
-            done_count += 1
-        elif state_val == "skip":
-            skip_count += 1
-        mark = habit_mark(day_log.get(key)) if key in day_log else "⬜"
-        if state_val != "none":
-            lines.append(f"{mark} {title}")
-    lines.append(f"Привычки: 🟩 {done_count}, 🟥 {skip_count}")
-
-    return "\n".join(lines)
+    return "\n".join(
+        chain(
+            evening_header_lines(day, done_tasks, len(tasks)),
+            evening_carry_lines(carry_report, bool(backlog_items)),
+            evening_backlog_lines(backlog_items),
+            evening_tomorrow_lines(tmr, tomorrow_obj["tasks"]),
+            evening_habits_lines(state, day),
+        )
+    )
 
 
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1295,7 +1738,8 @@ async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     state = load_user_state(user_id)
     days = state.get("days", {}) if isinstance(state.get("days"), dict) else {}
     today_iso = today_str()
-    day_obj = days.get(today_iso, {}) if isinstance(days.get(today_iso, {}), dict) else {}
+    raw = days.get(today_iso)
+    day_obj = raw if isinstance(raw, dict) else {}
     tasks = day_obj.get("tasks", []) if isinstance(day_obj.get("tasks", []), list) else []
     total_tasks = len(tasks)
     done_tasks = sum(1 for t in tasks if t.get("status") == "done")
@@ -1332,9 +1776,7 @@ async def cmd_today(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     day = today_str()
     day_obj = get_day(state, day)
-    context.user_data["view_scope"] = "day"
-    context.user_data["view_day"] = day
-    context.user_data["active_day"] = day
+    show_day_view(context, day)
 
     if day_obj.get("closed"):
         save_user_state(user_id, state)
@@ -1359,7 +1801,7 @@ async def cmd_today(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     overdue_items = [item for item in backlog if is_backlog_overdue(item, now)]
     if overdue_items:
         await update.message.reply_text(
-            render_overdue_backlog(overdue_items),
+            render_overdue_backlog(backlog, overdue_items),
             parse_mode=ParseMode.HTML,
             reply_markup=build_overdue_keyboard(overdue_items),
         )
@@ -1370,7 +1812,7 @@ async def cmd_done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     state = load_user_state(user_id)
 
     day = today_str()
-    day_obj = get_day(state, day)
+    day_obj = peek_day(state, day)
 
     if day_obj.get("closed"):
         await update.message.reply_text("Сегодняшний день уже закрыт. Напиши /today чтобы начать новый план.")
@@ -1400,26 +1842,18 @@ async def cmd_evening(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     state = load_user_state(user_id)
 
     day = today_str()
-    day_obj = get_day(state, day)
-
-    if day_obj.get("closed"):
+    if peek_day(state, day).get("closed"):
         await update.message.reply_text("День уже закрыт. Напиши /today чтобы увидеть план на сегодня.")
         return
 
+    day_obj = get_day(state, day)
     report = build_evening_report(state, day, day_obj)
     save_user_state(user_id, state)
     await update.message.reply_text(report, parse_mode=ParseMode.HTML)
 
 
-async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not update.message:
-        return
-    text = (update.message.text or "").strip()
-    if not text:
-        return
-    user_id = update.effective_user.id
-
-    button_labels = {
+BUTTON_LABELS = frozenset(
+    {
         "🏠 Главная",
         "📌 План на сегодня",
         "📅 План по дате",
@@ -1437,13 +1871,28 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         "🗂 Бэклог",
         "❌ Отмена",
     }
+)
+
+# Все кнопки начинаются с эмодзи: обычный текст отсекается по первому символу
+BUTTON_FIRST_CHARS = frozenset(label[0] for label in BUTTON_LABELS)
+
+
+def is_button_label(text: str) -> bool:
+    return bool(text) and text[0] in BUTTON_FIRST_CHARS and text in BUTTON_LABELS
+
+
+async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not update.message:
+        return
+    text = (update.message.text or "").strip()
+    if not text:
+        return
+    user_id = update.effective_user.id
+
+    is_button = is_button_label(text)
 
     if text == "🏠 Главная":
         reset_input_modes(context)
-        state = load_user_state(user_id)
-        if "backlog_edit" in state:
-            state.pop("backlog_edit", None)
-            save_user_state(user_id, state)
         await cmd_start(update, context)
         return
 
@@ -1452,26 +1901,22 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("Ок, отменил.", reply_markup=build_start_keyboard())
         return
 
-    if context.user_data.get("feedback_mode") == "awaiting_text" and text in button_labels:
+    if is_button and context.user_data.get("feedback_mode") == "awaiting_text":
         await update.message.reply_text(
             "Сейчас отзыв. Пришли текст одним сообщением или нажми ❌ Отмена.",
             reply_markup=build_cancel_keyboard(),
         )
         return
 
-    if context.user_data.get("awaiting_task_text") and text in button_labels:
+    if is_button and context.user_data.get("awaiting_task_text"):
         await update.message.reply_text(
             "Сейчас добавление задачи. Пришли текст одним сообщением или нажми ❌ Отмена.",
             reply_markup=build_cancel_keyboard(),
         )
         return
 
-    if text in button_labels:
+    if is_button:
         reset_input_modes(context)
-        state = load_user_state(user_id)
-        if "backlog_edit" in state:
-            state.pop("backlog_edit", None)
-            save_user_state(user_id, state)
 
         if text == "📌 План на сегодня":
             await cmd_today(update, context)
@@ -1563,7 +2008,7 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # управление бэклогом доступно внутри экрана "📦 Бэклог"
 
     if context.user_data.get("feedback_mode") == "awaiting_text":
-        if text in button_labels:
+        if is_button:
             await update.message.reply_text(
                 "Сейчас отзыв. Пришли текст одним сообщением или нажми ❌ Отмена.",
                 reply_markup=build_cancel_keyboard(),
@@ -1589,12 +2034,9 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return
 
         state = load_user_state(user_id)
-        day_obj = get_day(state, iso_date)
-        save_user_state(user_id, state)
+        day_obj = peek_day(state, iso_date)
         context.user_data.pop("view_date_mode", None)
-        context.user_data["view_scope"] = "day"
-        context.user_data["view_day"] = iso_date
-        context.user_data["active_day"] = iso_date
+        show_day_view(context, iso_date)
         await update.message.reply_text(render_plan(iso_date, day_obj), parse_mode=ParseMode.HTML)
         return
 
@@ -1605,8 +2047,9 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return
 
         state = load_user_state(user_id)
-        day = context.user_data.get("del_day") or context.user_data.get("active_day") or today_str()
-        day_obj = get_day(state, day)
+        today = today_str()
+        day = context.user_data.get("del_day") or context.user_data.get("active_day") or today
+        day_obj = peek_day(state, day)
         if day_obj.get("closed"):
             reset_input_modes(context)
             await update.message.reply_text("День закрыт (история). Удалять нельзя.")
@@ -1621,16 +2064,16 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return
 
         tasks = [t for t in tasks if t.get("id") not in ids]
-        day_obj["tasks"] = normalize_task_ids(tasks)
+        for i, t in enumerate(tasks, start=1):
+            t["id"] = i
+        day_obj["tasks"] = tasks
         save_user_state(user_id, state)
         reset_input_modes(context)
-        context.user_data["view_scope"] = "day"
-        context.user_data["view_day"] = day
-        context.user_data["active_day"] = day
+        show_day_view(context, day)
         removed_ids = [t.get("id") for t in removed]
         removed_text = ", ".join(str(i) for i in removed_ids)
         await update.message.reply_text(f"🗑 Удалено {len(removed_ids)} задач: {removed_text}")
-        reply_markup = build_today_keyboard(day_obj) if day == today_str() and not day_obj.get("closed") else None
+        reply_markup = build_today_keyboard(day_obj) if day == today and not day_obj.get("closed") else None
         await update.message.reply_text(
             render_plan(day, day_obj, show_hint=bool(reply_markup)),
             parse_mode=ParseMode.HTML,
@@ -1639,7 +2082,7 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     if context.user_data.get("awaiting_habit_title"):
-        if text in button_labels:
+        if is_button:
             await update.message.reply_text(
                 "Сейчас добавление привычки. Пришли текст одним сообщением или нажми ❌ Отмена.",
                 reply_markup=build_cancel_keyboard(),
@@ -1663,14 +2106,8 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         today = date.today()
         week_start_iso = context.user_data.get("habits_week_start")
         active_iso = context.user_data.get("habits_selected_day") or context.user_data.get("habits_selected_date")
-        try:
-            week_start = date.fromisoformat(week_start_iso) if week_start_iso else week_start_for(today)
-        except Exception:
-            week_start = week_start_for(today)
-        try:
-            active_date = date.fromisoformat(active_iso) if active_iso else today
-        except Exception:
-            active_date = today
+        week_start = parse_iso_date(week_start_iso) or week_start_for(today)
+        active_date = parse_iso_date(active_iso) or today
         context.user_data["habits_week_start"] = week_start.isoformat()
         context.user_data["habits_selected_day"] = active_date.isoformat()
         await update.message.reply_text(f"✅ Добавил привычку: {title}")
@@ -1703,15 +2140,14 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await update.message.reply_text("Не нашёл задачу в бэклоге.")
             return
 
-        day_obj = add_task_to_day(state, iso_date, item.get("text"))
-        backlog.remove(item)
-        backlog[:] = normalize_task_ids_backlog(backlog)
-        state["backlog"] = backlog
+        item_text = item.get("text")
+        day_obj = add_task_to_day(state, iso_date, item_text)
+        drop_backlog_item(backlog, item)
         save_user_state(user_id, state)
         context.user_data.pop("triage_date_mode", None)
         context.user_data.pop("triage_task_id", None)
         await update.message.reply_text(
-            f"✅ Перенёс на {format_date_ru(iso_date)}: {item.get('text')}"
+            f"✅ Перенёс на {format_date_ru(iso_date)}: {item_text}"
         )
         if backlog:
             await update.message.reply_text(
@@ -1745,18 +2181,15 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return
 
         day = iso_date
-        day_obj = add_task_to_day(state, day, item.get("text"))
-        backlog.remove(item)
-        backlog[:] = normalize_task_ids_backlog(backlog)
-        state["backlog"] = backlog
+        item_text = item.get("text")
+        day_obj = add_task_to_day(state, day, item_text)
+        drop_backlog_item(backlog, item)
         save_user_state(user_id, state)
         context.user_data.pop("move_mode", None)
         context.user_data.pop("move_task_id", None)
-        context.user_data["view_scope"] = "day"
-        context.user_data["view_day"] = day
-        context.user_data["active_day"] = day
+        show_day_view(context, day)
         await update.message.reply_text(
-            f"✅ Перенёс на {format_date_ru(day)}: {item.get('text')}"
+            f"✅ Перенёс на {format_date_ru(day)}: {item_text}"
         )
         await update.message.reply_text(render_plan(day, day_obj), parse_mode=ParseMode.HTML)
         return
@@ -1788,13 +2221,8 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
             day_obj = add_task_to_day(state, day, text)
             save_user_state(user_id, state)
-            context.user_data.pop("add_mode", None)
-            context.user_data.pop("add_date", None)
-            context.user_data.pop("pending_add_text", None)
-            context.user_data.pop("awaiting_task_text", None)
-            context.user_data["view_scope"] = "day"
-            context.user_data["view_day"] = day
-            context.user_data["active_day"] = day
+            pop_user_data(context, ("add_mode", "add_date", "pending_add_text", "awaiting_task_text"))
+            show_day_view(context, day)
             await update.message.reply_text(
                 render_plan(day, day_obj, show_hint=True),
                 parse_mode=ParseMode.HTML,
@@ -1808,12 +2236,8 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
             create_default_plan(day_obj)
             day_obj = add_task_to_day(state, day, text)
             save_user_state(user_id, state)
-            context.user_data.pop("add_mode", None)
-            context.user_data.pop("add_date", None)
-            context.user_data.pop("awaiting_task_text", None)
-            context.user_data["view_scope"] = "day"
-            context.user_data["view_day"] = day
-            context.user_data["active_day"] = day
+            pop_user_data(context, ADD_MODE_KEYS)
+            show_day_view(context, day)
             await update.message.reply_text(
                 render_plan(day, day_obj, show_hint=True),
                 parse_mode=ParseMode.HTML,
@@ -1824,12 +2248,8 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
             day = tomorrow_str()
             day_obj = add_task_to_day(state, day, text)
             save_user_state(user_id, state)
-            context.user_data.pop("add_mode", None)
-            context.user_data.pop("add_date", None)
-            context.user_data.pop("awaiting_task_text", None)
-            context.user_data["view_scope"] = "day"
-            context.user_data["view_day"] = day
-            context.user_data["active_day"] = day
+            pop_user_data(context, ADD_MODE_KEYS)
+            show_day_view(context, day)
             await update.message.reply_text(
                 f"✅ Добавил задачу на {format_date_ru(day)}: {text}"
             )
@@ -1842,12 +2262,8 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 return
             day_obj = add_task_to_day(state, day, text)
             save_user_state(user_id, state)
-            context.user_data.pop("add_mode", None)
-            context.user_data.pop("add_date", None)
-            context.user_data.pop("awaiting_task_text", None)
-            context.user_data["view_scope"] = "day"
-            context.user_data["view_day"] = day
-            context.user_data["active_day"] = day
+            pop_user_data(context, ADD_MODE_KEYS)
+            show_day_view(context, day)
             await update.message.reply_text(
                 f"✅ Добавил задачу на {format_date_ru(day)}: {text}"
             )
@@ -1857,7 +2273,7 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
             backlog = get_backlog(state)
             backlog.append(
                 {
-                    "id": len(backlog) + 1,
+                    "id": next_backlog_id(backlog),
                     "text": text,
                     "status": "todo",
                     "created_at": now_iso(),
@@ -1867,29 +2283,25 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
                     "carry_count": 0,
                 }
             )
-            backlog = normalize_task_ids_backlog(backlog)
             state["backlog"] = backlog
             save_user_state(user_id, state)
-            context.user_data.pop("add_mode", None)
-            context.user_data.pop("add_date", None)
-            context.user_data.pop("awaiting_task_text", None)
+            pop_user_data(context, ADD_MODE_KEYS)
             context.user_data["view_scope"] = "backlog"
             await update.message.reply_text(f"✅ Добавил в бэклог: {text}")
             await update.message.reply_text(f"📦 Сейчас в бэклоге: {len(backlog)}")
             await update.message.reply_text(render_backlog_tail(backlog))
             return
 
-    state = load_user_state(user_id)
-    pending = state.get("backlog_edit")
+    pending = context.user_data.pop("backlog_edit", None)
     if isinstance(pending, dict) and pending.get("id") is not None:
         try:
             item_id = int(pending.get("id"))
         except Exception:
             item_id = None
 
+        state = load_user_state(user_id)
         backlog = get_backlog(state)
         item = find_backlog_item(backlog, item_id) if item_id is not None else None
-        state.pop("backlog_edit", None)
         if item:
             item["text"] = text
             item["last_seen_at"] = now_iso()
@@ -1897,460 +2309,642 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await update.message.reply_text("✂️ Обновил формулировку.")
             await update.message.reply_text(render_backlog(backlog), parse_mode=ParseMode.HTML)
         else:
-            save_user_state(user_id, state)
             await update.message.reply_text("Не нашёл задачу в бэклоге.")
         return
 
 
-async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    if not query:
-        return
-
-    data = query.data or ""
-    if data == "cancel":
+@lru_cache(maxsize=4096)
+def parse_callback_ref(data: str) -> Optional[tuple[str, Optional[int]]]:
+    # "префикс:аргумент:номер" -> (аргумент, номер); номер None, если не число.
+    # Кнопки повторяются от сообщения к сообщению, поэтому разбор кэшируется.
+    parts = data.split(":")
+    if len(parts) != 3:
+        return None
+    try:
+        return parts[1], int(parts[2])
+    except ValueError:
+        return parts[1], None
+
+
+@lru_cache(maxsize=4096)
+def parse_move_ref(data: str) -> Optional[tuple[Optional[int], str]]:
+    # "move:номер:куда" — здесь номер идёт раньше действия, в отличие от parse_callback_ref
+    parts = data.split(":")
+    if len(parts) != 3:
+        return None
+    try:
+        return int(parts[1]), parts[2]
+    except ValueError:
+        return None, parts[2]
+
+
+async def edit_query_message(
+    query: CallbackQuery,
+    text: str,
+    reply_markup: InlineKeyboardMarkup,
+    parse_mode: Optional[str] = None,
+) -> None:
+    # Telegram присылает текущий текст и клавиатуру сообщения вместе с нажатием:
+    # если текст тот же, меняем только клавиатуру, а если совпадает всё — не ходим в API.
+    # HTML сравниваем с text_html, чтобы учитывалось и форматирование, а не только видимый текст
+    message = query.message
+    if parse_mode is None:
+        shown_text = getattr(message, "text", None)
+    elif parse_mode == ParseMode.HTML:
+        shown_text = getattr(message, "text_html", None)
+    else:
+        shown_text = None
+    if shown_text is not None and shown_text == text:
+        if getattr(message, "reply_markup", None) == reply_markup:
+            return
+        await message.edit_reply_markup(reply_markup=reply_markup)
+        return
+    if parse_mode is None:
+        await message.edit_text(text, reply_markup=reply_markup)
+    else:
+        await message.edit_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+
+
+async def cb_cancel(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    reset_input_modes(context)
+    await query.answer()
+    await query.message.reply_text("Ок, отменил.", reply_markup=build_start_keyboard())
+
+
+async def cb_noop(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    await query.answer("Показаны первые 10 задач.", show_alert=True)
+
+
+async def cb_feedback(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    user_id = query.from_user.id
+    admin_ids = get_admin_ids()
+    if not admin_ids:
         reset_input_modes(context)
         await query.answer()
-        await query.message.reply_text("Ок, отменил.", reply_markup=build_start_keyboard())
+        await query.message.reply_text("⚠️ Отзывы временно недоступны.")
         return
-    if data == "noop":
-        await query.answer("Показаны первые 10 задач.", show_alert=True)
+    feedback_text = context.user_data.get("feedback_text")
+    if not feedback_text:
+        reset_input_modes(context)
+        await query.answer("Не нашёл текст отзыва.", show_alert=True)
         return
-    if data.startswith("fb:"):
-        user_id = query.from_user.id
-        admin_ids = get_admin_ids()
-        if not admin_ids:
-            reset_input_modes(context)
-            await query.answer()
-            await query.message.reply_text("⚠️ Отзывы временно недоступны.")
-            return
-        feedback_text = context.user_data.get("feedback_text")
-        if not feedback_text:
-            reset_input_modes(context)
-            await query.answer("Не нашёл текст отзыва.", show_alert=True)
-            return
-        can_follow_up = data == "fb:ok"
-        state = load_user_state(user_id)
-        stats = state.get("feedback_stats")
-        if not isinstance(stats, dict):
-            stats = {"ok": 0, "anon": 0}
-        key = "ok" if can_follow_up else "anon"
-        stats[key] = int(stats.get(key, 0) or 0) + 1
-        state["feedback_stats"] = stats
-        save_user_state(user_id, state)
+    can_follow_up = data == "fb:ok"
+    state = load_user_state(user_id)
+    stats = state.get("feedback_stats")
+    if not isinstance(stats, dict):
+        stats = {"ok": 0, "anon": 0}
+    key = "ok" if can_follow_up else "anon"
+    stats[key] = int(stats.get(key, 0) or 0) + 1
+    state["feedback_stats"] = stats
+    save_user_state(user_id, state)
+
+    user = query.from_user
+    stamp = datetime.now().strftime("%d.%m.%Y %H:%M")
+    username = f"@{user.username}" if user.username else "-"
+    admin_text = (
+        "💬 Отзыв\n"
+        f"Время: {stamp}\n"
+        f"can_follow_up: {'yes' if can_follow_up else 'no'}\n"
+        f"user_id: {user.id}\n"
+        f"username: {username}\n"
+        f"first_name: {user.first_name}\n"
+        f"Текст: {feedback_text}"
+    )
+    for admin_id in admin_ids:
+        try:
+            await context.bot.send_message(chat_id=admin_id, text=admin_text)
+        except Exception:
+            continue
+
+    reset_input_modes(context)
+    await query.answer()
+    if can_follow_up:
+        await query.message.reply_text("Спасибо! Принято ✅ Если понадобится — уточню.")
+    else:
+        await query.message.reply_text("Спасибо! Принято ✅ (анонимно)")
 
-        user = query.from_user
-        stamp = datetime.now().strftime("%d.%m.%Y %H:%M")
-        username = f"@{user.username}" if user.username else "-"
-        admin_text = (
-            "💬 Отзыв\n"
-            f"Время: {stamp}\n"
-            f"can_follow_up: {'yes' if can_follow_up else 'no'}\n"
-            f"user_id: {user.id}\n"
-            f"username: {username}\n"
-            f"first_name: {user.first_name}\n"
-            f"Текст: {feedback_text}"
-        )
-        for admin_id in admin_ids:
-            try:
-                await context.bot.send_message(chat_id=admin_id, text=admin_text)
-            except Exception:
-                continue
 
+async def cb_notifications(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    user_id = query.from_user.id
+    state = load_user_state(user_id)
+    cfg = get_notifications(state)
+    settings = get_settings(state)
+    chat_id = query.message.chat_id if query.message else query.from_user.id
+    if data == "notif:back":
         reset_input_modes(context)
         await query.answer()
-        if can_follow_up:
-            await query.message.reply_text("Спасибо! Принято ✅ Если понадобится — уточню.")
-        else:
-            await query.message.reply_text("Спасибо! Принято ✅ (анонимно)")
+        await query.message.reply_text(get_start_message(), reply_markup=build_start_keyboard())
         return
-    if data.startswith("habit:"):
-        data = "hab:" + data.split("habit:", 1)[1]
+    if data == "notif:toggle":
+        current = notifications_enabled(state)
+        settings["notifications_enabled"] = not current
+        state["settings"] = settings
+        cfg["enabled"] = settings["notifications_enabled"]
+        state["notifications"] = cfg
+        save_user_state(user_id, state)
+        schedule_notifications(context, user_id, chat_id, state)
+        await query.answer()
+    if data == "notif:morning":
+        cfg["morning"] = "09:00"
+        state["notifications"] = cfg
+        save_user_state(user_id, state)
+        schedule_notifications(context, user_id, chat_id, state)
+        await query.answer("Утреннее уведомление: 09:00")
+    if data == "notif:evening":
+        cfg["evening"] = "21:30"
+        state["notifications"] = cfg
+        save_user_state(user_id, state)
+        schedule_notifications(context, user_id, chat_id, state)
+        await query.answer("Вечернее уведомление: 21:30")
 
-    if data.startswith("notif:"):
-        user_id = query.from_user.id
-        state = load_user_state(user_id)
-        cfg = get_notifications(state)
-        settings = get_settings(state)
-        chat_id = query.message.chat_id if query.message else query.from_user.id
-        if data == "notif:back":
-            reset_input_modes(context)
-            await query.answer()
-            await query.message.reply_text(get_start_message(), reply_markup=build_start_keyboard())
-            return
-        if data == "notif:toggle":
-            current = notifications_enabled(state)
-            settings["notifications_enabled"] = not current
-            state["settings"] = settings
-            cfg["enabled"] = settings["notifications_enabled"]
-            state["notifications"] = cfg
-            save_user_state(user_id, state)
-            schedule_notifications(context, user_id, chat_id, state)
-            await query.answer()
-        if data == "notif:morning":
-            cfg["morning"] = "09:00"
-            state["notifications"] = cfg
-            save_user_state(user_id, state)
-            schedule_notifications(context, user_id, chat_id, state)
-            await query.answer("Утреннее уведомление: 09:00")
-        if data == "notif:evening":
-            cfg["evening"] = "21:30"
-            state["notifications"] = cfg
-            save_user_state(user_id, state)
-            schedule_notifications(context, user_id, chat_id, state)
-            await query.answer("Вечернее уведомление: 21:30")
+    text_msg = (
+        f"🔔 Уведомления: {'включены' if notifications_enabled(state) else 'выключены'}\n"
+        f"Утро: {cfg.get('morning')}\n"
+        f"Вечер: {cfg.get('evening')}"
+    )
+    await edit_query_message(query, text_msg, reply_markup=build_notifications_keyboard(state))
 
-        text_msg = (
-            f"🔔 Уведомления: {'включены' if notifications_enabled(state) else 'выключены'}\n"
-            f"Утро: {cfg.get('morning')}\n"
-            f"Вечер: {cfg.get('evening')}"
-        )
-        await query.message.edit_text(text_msg, reply_markup=build_notifications_keyboard(state))
-        return
 
-    if data.startswith("del_pick_day:"):
-        day = data.split(":", 1)[1]
-        user_id = query.from_user.id
-        state = load_user_state(user_id)
-        day_obj = get_day(state, day)
-        if not day_obj.get("tasks"):
-            await query.answer()
-            await query.message.edit_text(
+async def cb_delete_pick_day(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    day = data.split(":", 1)[1]
+    user_id = query.from_user.id
+    state = load_user_state(user_id)
+    day_obj = peek_day(state, day)
+    if not day_obj.get("tasks"):
+        await asyncio.gather(
+            query.answer(),
+            edit_query_message(
+                query,
                 "В этом дне нет задач.",
                 reply_markup=build_delete_day_keyboard(state, context.user_data.get("active_day")),
-            )
-            return
-        context.user_data["del_day"] = day
-        context.user_data["awaiting_del_id"] = True
-        await query.answer()
-        await query.message.edit_text(
-            f"Задачи на {format_date_ru(day)}:",
-            reply_markup=build_delete_tasks_keyboard(day, day_obj),
+            ),
         )
         return
+    context.user_data["del_day"] = day
+    context.user_data["awaiting_del_id"] = True
+    await asyncio.gather(
+        query.answer(),
+        edit_query_message(
+            query,
+            f"Задачи на {format_date_ru(day)}:",
+            reply_markup=build_delete_tasks_keyboard(day, day_obj),
+        ),
+    )
 
-    if data == "del_back":
-        user_id = query.from_user.id
-        state = load_user_state(user_id)
-        await query.answer()
-        await query.message.edit_text(
+
+async def cb_delete_back(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    user_id = query.from_user.id
+    state = load_user_state(user_id)
+    await asyncio.gather(
+        query.answer(),
+        edit_query_message(
+            query,
             "Выбери день, где удалить задачи",
             reply_markup=build_delete_day_keyboard(state, context.user_data.get("active_day")),
-        )
-        return
+        ),
+    )
 
-    if data.startswith("del_one:"):
-        parts = data.split(":")
-        if len(parts) != 3:
-            await query.answer("Неверные данные.", show_alert=True)
-            return
-        day = parts[1]
-        try:
-            task_id = int(parts[2])
-        except ValueError:
-            await query.answer("Неверный номер задачи.", show_alert=True)
-            return
-        user_id = query.from_user.id
-        state = load_user_state(user_id)
-        day_obj = get_day(state, day)
-        task = find_task(day_obj, task_id)
-        if not task:
-            await query.answer("Задача не найдена.", show_alert=True)
-            return
-        tasks = [t for t in day_obj.get("tasks", []) if t.get("id") != task_id]
-        day_obj["tasks"] = normalize_task_ids(tasks)
-        save_user_state(user_id, state)
-        await query.answer(f"🗑 Удалено: {shorten_text(str(task.get('text', '')), 24)}")
-        if not day_obj.get("tasks"):
-            await query.message.edit_text(
-                f"Задачи на {format_date_ru(day)} отсутствуют.",
-                reply_markup=build_delete_day_keyboard(state, context.user_data.get("active_day")),
-            )
-            return
-        await query.message.edit_text(
-            f"Задачи на {format_date_ru(day)}:",
-            reply_markup=build_delete_tasks_keyboard(day, day_obj),
-        )
-        return
 
-    if data.startswith("triage:"):
-        user_id = query.from_user.id
-        state = load_user_state(user_id)
-        backlog = get_backlog(state)
-        if data == "triage:cancel":
-            reset_input_modes(context)
-            await query.answer()
-            await query.message.reply_text("Ок, отменил.", reply_markup=build_start_keyboard())
-            return
-        if data == "triage:back":
-            await query.answer()
-            if not backlog:
-                await query.message.reply_text("📦 Бэклог пуст.")
-            else:
-                await query.message.reply_text(
-                    render_triage_list(backlog),
-                    reply_markup=build_triage_keyboard(backlog),
-                )
-            return
-        try:
-            item_id = int(data.split(":", 1)[1])
-        except ValueError:
-            await query.answer("Неверный номер задачи.", show_alert=True)
-            return
-        item = find_backlog_item(backlog, item_id)
-        if not item:
-            await query.answer("Задача не найдена в бэклоге.", show_alert=True)
-            return
-        await query.answer()
-        await query.message.reply_text(
-            f"Задача: {item.get('text')}\nКуда её поставить?",
-            reply_markup=build_triage_to_keyboard(item_id, include_today=True),
+async def cb_delete_one(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    ref = parse_callback_ref(data)
+    if ref is None:
+        await query.answer("Неверные данные.", show_alert=True)
+        return
+    day, task_id = ref
+    if task_id is None:
+        await query.answer("Неверный номер задачи.", show_alert=True)
+        return
+    user_id = query.from_user.id
+    state = load_user_state(user_id)
+    day_obj = peek_day(state, day)
+    task = drop_task(day_obj, task_id)
+    if not task:
+        await query.answer("Задача не найдена.", show_alert=True)
+        return
+    save_user_state(user_id, state)
+    await query.answer(f"🗑 Удалено: {shorten_text(str(task.get('text', '')), 24)}")
+    if not day_obj.get("tasks"):
+        await edit_query_message(
+            query,
+            f"Задачи на {format_date_ru(day)} отсутствуют.",
+            reply_markup=build_delete_day_keyboard(state, context.user_data.get("active_day")),
         )
         return
+    await edit_query_message(
+        query,
+        f"Задачи на {format_date_ru(day)}:",
+        reply_markup=build_delete_tasks_keyboard(day, day_obj),
+    )
 
-    if data.startswith("triage_to:"):
-        parts = data.split(":")
-        if len(parts) != 3:
-            await query.answer("Неверные данные.", show_alert=True)
-            return
-        target = parts[1]
-        try:
-            item_id = int(parts[2])
-        except ValueError:
-            await query.answer("Неверный номер задачи.", show_alert=True)
-            return
-
-        user_id = query.from_user.id
-        state = load_user_state(user_id)
-        backlog = get_backlog(state)
-        item = find_backlog_item(backlog, item_id)
-        if not item:
-            await query.answer("Задача не найдена в бэклоге.", show_alert=True)
-            return
-
-        if target == "date":
-            context.user_data["triage_date_mode"] = True
-            context.user_data["triage_task_id"] = item_id
-            await query.answer()
-            await query.message.reply_text(DATE_INPUT_ERROR, reply_markup=build_cancel_keyboard())
-            return
 
-        if target == "delete":
-            backlog.remove(item)
-            backlog[:] = normalize_task_ids_backlog(backlog)
-            state["backlog"] = backlog
-            save_user_state(user_id, state)
-            await query.answer("Удалил.")
-            await query.message.reply_text(f"🗑 Удалил задачу: {item.get('text')}")
+async def cb_triage(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    user_id = query.from_user.id
+    state = load_user_state(user_id)
+    backlog = get_backlog(state)
+    if data == "triage:cancel":
+        reset_input_modes(context)
+        await query.answer()
+        await query.message.reply_text("Ок, отменил.", reply_markup=build_start_keyboard())
+        return
+    if data == "triage:back":
+        await query.answer()
+        if not backlog:
+            await query.message.reply_text("📦 Бэклог пуст.")
         else:
-            day = today_str() if target == "today" else tomorrow_str()
-            day_obj = get_day(state, day)
-            if target == "today" and day_obj.get("closed"):
-                await query.answer("Сегодня закрыт. Выбери другую дату.", show_alert=True)
-                await query.message.reply_text(
-                    "Сегодня закрыт. Выбери другую дату.",
-                    reply_markup=build_triage_to_keyboard(item_id, include_today=False),
-                )
-                return
-            add_task_to_day(state, day, item.get("text"))
-            backlog.remove(item)
-            backlog[:] = normalize_task_ids_backlog(backlog)
-            state["backlog"] = backlog
-            save_user_state(user_id, state)
-            await query.answer()
-            await query.message.reply_text(
-                f"✅ Перенёс на {format_date_ru(day)}: {item.get('text')}"
-            )
-
-        if backlog:
             await query.message.reply_text(
                 render_triage_list(backlog),
                 reply_markup=build_triage_keyboard(backlog),
             )
-        else:
-            await query.message.reply_text("📦 Бэклог пуст.")
         return
+    try:
+        item_id = int(data.split(":", 1)[1])
+    except ValueError:
+        await query.answer("Неверный номер задачи.", show_alert=True)
+        return
+    item = find_backlog_item(backlog, item_id)
+    if not item:
+        await query.answer("Задача не найдена в бэклоге.", show_alert=True)
+        return
+    await query.answer()
+    await query.message.reply_text(
+        f"Задача: {item.get('text')}\nКуда её поставить?",
+        reply_markup=build_triage_to_keyboard(item_id, include_today=True),
+    )
 
-    if data.startswith("hab:") or data.startswith("habits_pick_day:"):
-        user_id = query.from_user.id
-        state = load_user_state(user_id)
-        today = date.today()
-        week_start_iso = context.user_data.get("habits_week_start")
-        selected_iso = context.user_data.get("habits_selected_day") or context.user_data.get("habits_selected_date")
-        try:
-            week_start = date.fromisoformat(week_start_iso) if week_start_iso else None
-        except Exception:
-            week_start = None
-        try:
-            selected_date = date.fromisoformat(selected_iso) if selected_iso else today
-        except Exception:
-            selected_date = today
-        if not week_start:
-            week_start = week_start_for(selected_date)
-        habits_screen = context.user_data.get("habits_screen", "main")
 
-        if data == "hab:home":
-            reset_input_modes(context)
-            await query.answer()
-            await query.message.reply_text(get_start_message(), reply_markup=build_start_keyboard())
+async def cb_triage_to(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    ref = parse_callback_ref(data)
+    if ref is None:
+        await query.answer("Неверные данные.", show_alert=True)
+        return
+    target, item_id = ref
+    if item_id is None:
+        await query.answer("Неверный номер задачи.", show_alert=True)
+        return
+
+    user_id = query.from_user.id
+    state = load_user_state(user_id)
+    backlog = get_backlog(state)
+    item = find_backlog_item(backlog, item_id)
+    if not item:
+        await query.answer("Задача не найдена в бэклоге.", show_alert=True)
+        return
+
+    if target == "date":
+        context.user_data["triage_date_mode"] = True
+        context.user_data["triage_task_id"] = item_id
+        await query.answer()
+        await query.message.reply_text(DATE_INPUT_ERROR, reply_markup=build_cancel_keyboard())
+        return
+
+    if target == "delete":
+        drop_backlog_item(backlog, item)
+        save_user_state(user_id, state)
+        await query.answer("Удалил.")
+        await query.message.reply_text(f"🗑 Удалил задачу: {item.get('text')}")
+    else:
+        day = today_str() if target == "today" else tomorrow_str()
+        day_obj = get_day(state, day)
+        if target == "today" and day_obj.get("closed"):
+            await query.answer("Сегодня закрыт. Выбери другую дату.", show_alert=True)
+            await query.message.reply_text(
+                "Сегодня закрыт. Выбери другую дату.",
+                reply_markup=build_triage_to_keyboard(item_id, include_today=False),
+            )
             return
-        if data == "hab:back":
-            context.user_data["habits_screen"] = "main"
-            await query.answer()
-            await query.message.edit_text(
+        add_task_to_day(state, day, item.get("text"))
+        drop_backlog_item(backlog, item)
+        save_user_state(user_id, state)
+        await query.answer()
+        await query.message.reply_text(
+            f"✅ Перенёс на {format_date_ru(day)}: {item.get('text')}"
+        )
+
+    if backlog:
+        await query.message.reply_text(
+            render_triage_list(backlog),
+            reply_markup=build_triage_keyboard(backlog),
+        )
+    else:
+        await query.message.reply_text("📦 Бэклог пуст.")
+
+
+async def cb_habits(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    user_id = query.from_user.id
+    state = load_user_state(user_id)
+    week_start_iso = context.user_data.get("habits_week_start")
+    selected_iso = context.user_data.get("habits_selected_day") or context.user_data.get("habits_selected_date")
+    selected_date = parse_iso_date(selected_iso) or date.today()
+    week_start = parse_iso_date(week_start_iso) or week_start_for(selected_date)
+    habits_screen = context.user_data.get("habits_screen", "main")
+
+    if data == "hab:home":
+        reset_input_modes(context)
+        await query.answer()
+        await query.message.reply_text(get_start_message(), reply_markup=build_start_keyboard())
+        return
+    if data == "hab:back":
+        context.user_data["habits_screen"] = "main"
+        await asyncio.gather(
+            query.answer(),
+            edit_query_message(
+                query,
                 render_habits_week(state, week_start, selected_date),
                 parse_mode=ParseMode.HTML,
                 reply_markup=build_habits_keyboard(state, week_start),
-            )
-            return
-        if data == "hab:settings":
-            context.user_data.pop("awaiting_habit_title", None)
-            context.user_data["habits_screen"] = "settings"
-            await query.answer()
-            await query.message.edit_text(
+            ),
+        )
+        return
+    if data == "hab:settings":
+        context.user_data.pop("awaiting_habit_title", None)
+        context.user_data["habits_screen"] = "settings"
+        await asyncio.gather(
+            query.answer(),
+            edit_query_message(
+                query,
                 render_habits_week(state, week_start, selected_date),
                 parse_mode=ParseMode.HTML,
                 reply_markup=build_habits_settings_keyboard(week_start, selected_date),
-            )
-            return
-        if data == "hab:add":
-            context.user_data["awaiting_habit_title"] = True
-            await query.answer()
-            await query.message.reply_text(
-                "Напиши название привычки одним сообщением.",
-                reply_markup=build_cancel_keyboard(),
-            )
-            return
-        if data == "hab:del":
-            config = get_habits_config(state)
-            save_user_state(user_id, state)
-            await query.answer()
-            await query.message.edit_text(
+            ),
+        )
+        return
+    if data == "hab:add":
+        context.user_data["awaiting_habit_title"] = True
+        await query.answer()
+        await query.message.reply_text(
+            "Напиши название привычки одним сообщением.",
+            reply_markup=build_cancel_keyboard(),
+        )
+        return
+    if data == "hab:del":
+        config = get_habits_config(state)
+        await asyncio.gather(
+            query.answer(),
+            edit_query_message(
+                query,
                 "Выбери привычку для удаления:",
                 reply_markup=build_habits_delete_keyboard(config),
-            )
-            return
-        if data.startswith("hab:del:"):
-            key = data.split(":", 2)[2]
-            config = get_habits_config(state)
-            config = [h for h in config if str(h.get("key", "")) != key]
-            state["habits_config"] = config
-            save_user_state(user_id, state)
-            await query.answer("Удалил привычку.")
-            await query.message.edit_text(
+            ),
+        )
+        return
+    if data.startswith("hab:del:"):
+        key = data.split(":", 2)[2]
+        config = get_habits_config(state)
+        config = [h for h in config if str(h.get("key", "")) != key]
+        state["habits_config"] = config
+        save_user_state(user_id, state)
+        await asyncio.gather(
+            query.answer("Удалил привычку."),
+            edit_query_message(
+                query,
                 render_habits_week(state, week_start, selected_date),
                 parse_mode=ParseMode.HTML,
                 reply_markup=build_habits_keyboard(state, week_start),
-            )
-            return
-        if data == "hab:pick_day":
-            context.user_data["habits_screen"] = "pick_day"
-            await query.answer()
-            await query.message.edit_text(
+            ),
+        )
+        return
+    if data == "hab:pick_day":
+        context.user_data["habits_screen"] = "pick_day"
+        await asyncio.gather(
+            query.answer(),
+            edit_query_message(
+                query,
                 render_habits_week(state, week_start, selected_date),
                 parse_mode=ParseMode.HTML,
                 reply_markup=build_habits_day_picker_keyboard(week_start),
-            )
-            return
-        if data == "hab:week_prev":
-            week_start = week_start - timedelta(days=7)
-            context.user_data["habits_week_start"] = week_start.isoformat()
-            selected_date = week_start + timedelta(days=selected_date.weekday())
-            context.user_data["habits_selected_day"] = selected_date.isoformat()
-            reply_markup = (
-                build_habits_settings_keyboard(week_start, selected_date)
-                if habits_screen == "settings"
-                else build_habits_keyboard(state, week_start)
-            )
-            await query.answer()
-            await query.message.edit_text(
+            ),
+        )
+        return
+    if data == "hab:week_prev":
+        week_start = week_start - timedelta(days=7)
+        context.user_data["habits_week_start"] = week_start.isoformat()
+        selected_date = week_start + timedelta(days=selected_date.weekday())
+        context.user_data["habits_selected_day"] = selected_date.isoformat()
+        reply_markup = (
+            build_habits_settings_keyboard(week_start, selected_date)
+            if habits_screen == "settings"
+            else build_habits_keyboard(state, week_start)
+        )
+        await asyncio.gather(
+            query.answer(),
+            edit_query_message(
+                query,
                 render_habits_week(state, week_start, selected_date),
                 parse_mode=ParseMode.HTML,
                 reply_markup=reply_markup,
-            )
-            return
-        if data == "hab:week_next":
-            week_start = week_start + timedelta(days=7)
-            context.user_data["habits_week_start"] = week_start.isoformat()
-            selected_date = week_start + timedelta(days=selected_date.weekday())
-            context.user_data["habits_selected_day"] = selected_date.isoformat()
-            reply_markup = (
-                build_habits_settings_keyboard(week_start, selected_date)
-                if habits_screen == "settings"
-                else build_habits_keyboard(state, week_start)
-            )
-            await query.answer()
-            await query.message.edit_text(
+            ),
+        )
+        return
+    if data == "hab:week_next":
+        week_start = week_start + timedelta(days=7)
+        context.user_data["habits_week_start"] = week_start.isoformat()
+        selected_date = week_start + timedelta(days=selected_date.weekday())
+        context.user_data["habits_selected_day"] = selected_date.isoformat()
+        reply_markup = (
+            build_habits_settings_keyboard(week_start, selected_date)
+            if habits_screen == "settings"
+            else build_habits_keyboard(state, week_start)
+        )
+        await asyncio.gather(
+            query.answer(),
+            edit_query_message(
+                query,
                 render_habits_week(state, week_start, selected_date),
                 parse_mode=ParseMode.HTML,
                 reply_markup=reply_markup,
-            )
-            return
-        if data.startswith("habits_pick_day:"):
-            code = data.split(":", 1)[1]
-            if code == "cancel":
-                context.user_data["habits_screen"] = "main"
-                await query.answer()
-                await query.message.edit_text(
+            ),
+        )
+        return
+    if data.startswith("habits_pick_day:"):
+        code = data.split(":", 1)[1]
+        if code == "cancel":
+            context.user_data["habits_screen"] = "main"
+            await asyncio.gather(
+                query.answer(),
+                edit_query_message(
+                    query,
                     render_habits_week(state, week_start, selected_date),
                     parse_mode=ParseMode.HTML,
                     reply_markup=build_habits_keyboard(state, week_start),
-                )
-                return
-            week_map = {"mon": 0, "tue": 1, "wed": 2, "thu": 3, "fri": 4, "sat": 5, "sun": 6}
-            idx = week_map.get(code)
-            if idx is None:
-                selected_date = today
-            else:
-                selected_date = week_start + timedelta(days=idx)
-            context.user_data["habits_selected_day"] = selected_date.isoformat()
-            context.user_data["habits_week_start"] = week_start_for(selected_date).isoformat()
-            context.user_data["habits_screen"] = "main"
-            await query.answer()
-            await query.message.edit_text(
+                ),
+            )
+            return
+        week_map = {"mon": 0, "tue": 1, "wed": 2, "thu": 3, "fri": 4, "sat": 5, "sun": 6}
+        idx = week_map.get(code)
+        if idx is None:
+            selected_date = date.today()
+        else:
+            selected_date = week_start + timedelta(days=idx)
+        context.user_data["habits_selected_day"] = selected_date.isoformat()
+        context.user_data["habits_week_start"] = week_start_for(selected_date).isoformat()
+        context.user_data["habits_screen"] = "main"
+        await asyncio.gather(
+            query.answer(),
+            edit_query_message(
+                query,
                 render_habits_week(state, week_start_for(selected_date), selected_date),
                 parse_mode=ParseMode.HTML,
                 reply_markup=build_habits_keyboard(state, week_start_for(selected_date)),
-            )
-            return
-        if data.startswith("hab:toggle:"):
-            parts = data.split(":")
-            key = parts[2] if len(parts) > 2 else ""
-            iso_override = parts[3] if len(parts) > 3 else None
-            log = get_habits_log(state)
-            selected_iso = iso_override or selected_date.isoformat()
-            log.setdefault(selected_iso, {})
-            next_value = habit_next_value(log[selected_iso].get(key))
-            if next_value is None:
-                log[selected_iso].pop(key, None)
-            else:
-                log[selected_iso][key] = next_value
-            state["habits_log"] = log
-            save_user_state(user_id, state)
-            context.user_data["habits_screen"] = "main"
-            await query.answer("Готово.")
-            await query.message.edit_text(
+            ),
+        )
+        return
+    if data.startswith("hab:toggle:"):
+        parts = data.split(":")
+        key = parts[2] if len(parts) > 2 else ""
+        iso_override = parts[3] if len(parts) > 3 else None
+        log = get_habits_log(state)
+        selected_iso = iso_override or selected_date.isoformat()
+        log.setdefault(selected_iso, {})
+        next_value = habit_next_value(log[selected_iso].get(key))
+        if next_value is None:
+            log[selected_iso].pop(key, None)
+        else:
+            log[selected_iso][key] = next_value
+        state["habits_log"] = log
+        save_user_state(user_id, state)
+        context.user_data["habits_screen"] = "main"
+        await asyncio.gather(
+            query.answer("Готово."),
+            edit_query_message(
+                query,
                 render_habits_week(state, week_start, selected_date),
                 parse_mode=ParseMode.HTML,
                 reply_markup=build_habits_keyboard(state, week_start),
-            )
+            ),
+        )
+        return
+
+
+async def cb_day(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    action = data.split(":", 1)[1]
+    user_id = query.from_user.id
+    state = load_user_state(user_id)
+    day = today_str()
+    if action in {"reopen", "reopen_today"}:
+        day_obj = get_day(state, day)
+        day_obj["closed"] = False
+        day_obj.pop("closed_at", None)
+        if not day_obj.get("tasks"):
+            create_default_plan(day_obj)
+        save_user_state(user_id, state)
+        show_day_view(context, day)
+        await query.answer()
+        await query.message.reply_text(
+            render_plan(day, day_obj, show_hint=True),
+            parse_mode=ParseMode.HTML,
+            reply_markup=build_today_keyboard(day_obj),
+        )
+        return
+    if action in {"tomorrow_preview", "show_tomorrow"}:
+        tmr = tomorrow_str()
+        tmr_obj = peek_day(state, tmr)
+        show_day_view(context, tmr)
+        await query.answer()
+        await query.message.reply_text(render_plan(tmr, tmr_obj), parse_mode=ParseMode.HTML)
+        return
+
+
+async def cb_date(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    parts = data.split(":")
+    if len(parts) == 2 and parts[1] == "input":
+        reset_input_modes(context)
+        context.user_data["view_date_mode"] = True
+        await query.answer()
+        await query.message.reply_text(DATE_INPUT_ERROR, reply_markup=build_cancel_keyboard())
+        return
+    if len(parts) == 2 and parts[1] == "list":
+        user_id = query.from_user.id
+        state = load_user_state(user_id)
+        # Один проход по дням: берём 10 самых ранних непустых сразу вместе с числом задач
+        counts = heapq.nsmallest(
+            10,
+            (
+                (day_key, len(day_obj["tasks"]))
+                for day_key, day_obj in state.get("days", {}).items()
+                if day_obj.get("tasks")
+            ),
+        )
+        dates = [iso for iso, _ in counts]
+        await query.answer()
+        if not dates:
+            await query.message.reply_text("Нет дат с задачами.", reply_markup=build_cancel_keyboard())
             return
+        lines = ["Даты с задачами:"]
+        for iso, count in counts:
+            lines.append(f"{format_date_ru(iso)} — {count} задач")
+        await query.message.reply_text(
+            "\n".join(lines),
+            reply_markup=build_date_list_keyboard(dates),
+        )
+        return
+    if len(parts) == 3 and parts[1] == "open":
+        iso = parts[2]
+        user_id = query.from_user.id
+        state = load_user_state(user_id)
+        day_obj = peek_day(state, iso)
+        show_day_view(context, iso)
+        await query.answer()
+        await query.message.reply_text(render_plan(iso, day_obj), parse_mode=ParseMode.HTML)
+        return
+
 
-    if data.startswith("day:") or data.startswith("today:"):
-        action = data.split(":", 1)[1]
+async def cb_done(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    try:
+        task_id = int(data.split(":", 1)[1])
+    except ValueError:
+        await query.answer("Неверный номер задачи.", show_alert=True)
+        return
+
+    user_id = query.from_user.id
+    state = load_user_state(user_id)
+    day = today_str()
+    day_obj = peek_day(state, day)
+    active_day = context.user_data.get("active_day")
+    if active_day and active_day != day:
+        await query.answer("Отмечать можно только в плане на сегодня.", show_alert=True)
+        return
+    if day_obj.get("closed"):
+        await query.answer("Отмечать можно только в плане на сегодня.", show_alert=True)
+        return
+
+    show_day_view(context, day)
+
+    ok, message = apply_done(day_obj, task_id)
+    if not ok:
+        await query.answer(message, show_alert=True)
+        return
+
+    save_user_state(user_id, state)
+    await asyncio.gather(
+        query.edit_message_text(
+            render_plan(day, day_obj, show_hint=True),
+            parse_mode=ParseMode.HTML,
+            reply_markup=build_today_keyboard(day_obj),
+        ),
+        query.answer(message),
+    )
+
+
+async def cb_add(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    mode = data.split(":", 1)[1]
+    if mode not in {"today", "tomorrow", "date", "backlog", "reopen_today"}:
+        await query.answer("Неверный режим.", show_alert=True)
+        return
+
+    pending_text = context.user_data.pop("pending_add_text", None)
+
+    if mode in {"tomorrow", "reopen_today"} and pending_text:
         user_id = query.from_user.id
         state = load_user_state(user_id)
-        day = today_str()
-        day_obj = get_day(state, day)
-        if action in {"reopen", "reopen_today"}:
-            day_obj["closed"] = False
-            day_obj.pop("closed_at", None)
-            if not day_obj.get("tasks"):
-                create_default_plan(day_obj)
+        if mode == "reopen_today":
+            day = today_str()
+            day_obj = {"tasks": [], "closed": False, "created_at": now_iso()}
+            state.setdefault("days", {})[day] = day_obj
+            create_default_plan(day_obj)
+            day_obj = add_task_to_day(state, day, pending_text)
             save_user_state(user_id, state)
-            context.user_data["view_scope"] = "day"
-            context.user_data["view_day"] = day
-            context.user_data["active_day"] = day
+            show_day_view(context, day)
+            context.user_data.pop("awaiting_task_text", None)
             await query.answer()
             await query.message.reply_text(
                 render_plan(day, day_obj, show_hint=True),
@@ -2358,515 +2952,401 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 reply_markup=build_today_keyboard(day_obj),
             )
             return
-        if action in {"tomorrow_preview", "show_tomorrow"}:
-            tmr = tomorrow_str()
-            tmr_obj = get_day(state, tmr)
-            save_user_state(user_id, state)
-            context.user_data["view_scope"] = "day"
-            context.user_data["view_day"] = tmr
-            context.user_data["active_day"] = tmr
-            await query.answer()
-            await query.message.reply_text(render_plan(tmr, tmr_obj), parse_mode=ParseMode.HTML)
-            return
 
-    if data.startswith("date:"):
-        parts = data.split(":")
-        if len(parts) == 2 and parts[1] == "input":
-            reset_input_modes(context)
-            context.user_data["view_date_mode"] = True
-            await query.answer()
-            await query.message.reply_text(DATE_INPUT_ERROR, reply_markup=build_cancel_keyboard())
-            return
-        if len(parts) == 2 and parts[1] == "list":
-            user_id = query.from_user.id
-            state = load_user_state(user_id)
-            days = state.get("days", {})
-            dates = []
-            for day_key, day_obj in days.items():
-                tasks = day_obj.get("tasks", [])
-                if tasks:
-                    dates.append(day_key)
-            dates = sorted(dates)[:10]
-            await query.answer()
-            if not dates:
-                await query.message.reply_text("Нет дат с задачами.", reply_markup=build_cancel_keyboard())
-                return
-            lines = ["Даты с задачами:"]
-            for iso in dates:
-                count = len(days.get(iso, {}).get("tasks", []))
-                lines.append(f"{format_date_ru(iso)} — {count} задач")
-            await query.message.reply_text(
-                "\n".join(lines),
-                reply_markup=build_date_list_keyboard(dates),
-            )
-            return
-        if len(parts) == 3 and parts[1] == "open":
-            iso = parts[2]
-            user_id = query.from_user.id
-            state = load_user_state(user_id)
-            day_obj = get_day(state, iso)
-            save_user_state(user_id, state)
-            context.user_data["view_scope"] = "day"
-            context.user_data["view_day"] = iso
-            context.user_data["active_day"] = iso
-            await query.answer()
-            await query.message.reply_text(render_plan(iso, day_obj), parse_mode=ParseMode.HTML)
-            return
+        day = tomorrow_str()
+        day_obj = add_task_to_day(state, day, pending_text)
+        save_user_state(user_id, state)
+        show_day_view(context, day)
+        context.user_data.pop("awaiting_task_text", None)
+        await query.answer()
+        await query.message.reply_text(
+            f"✅ Добавил задачу на {format_date_ru(day)}: {pending_text}"
+        )
+        await query.message.reply_text(render_day_preview(day, day_obj, include_text=pending_text))
+        return
+
+    if mode == "reopen_today":
+        context.user_data["add_mode"] = "reopen_today"
+        context.user_data.pop("add_date", None)
+        context.user_data["awaiting_task_text"] = True
+        await query.answer()
+        await query.message.reply_text(
+            "Напиши текст задачи одним сообщением.",
+            reply_markup=build_cancel_keyboard(),
+        )
+        return
 
+    context.user_data["add_mode"] = mode
+    pop_user_data(
+        context,
+        ("add_date", "awaiting_task_text", "del_mode", "awaiting_del_id", "move_mode", "move_task_id"),
+    )
+    await query.answer()
+    if mode == "date":
+        await query.message.reply_text(DATE_INPUT_ERROR, reply_markup=build_cancel_keyboard())
+    else:
+        context.user_data["awaiting_task_text"] = True
+        await query.message.reply_text(
+            "Напиши текст задачи одним сообщением.",
+            reply_markup=build_cancel_keyboard(),
+        )
 
-    if data.startswith("done:"):
-        try:
-            task_id = int(data.split(":", 1)[1])
-        except ValueError:
-            await query.answer("Неверный номер задачи.", show_alert=True)
-            return
 
+async def cb_pick(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    if data == "pick:back":
+        pop_user_data(
+            context,
+            ("move_mode", "move_task_id", "add_mode", "add_date", "del_mode", "awaiting_del_id", "take_mode"),
+        )
         user_id = query.from_user.id
         state = load_user_state(user_id)
+        backlog = get_backlog(state)
+        await query.answer()
+        if not backlog:
+            await query.message.reply_text("📦 Бэклог пуст.")
+        else:
+            message = "Нажми на задачу, чтобы перенести в план или удалить."
+            message += "\n\n" + render_backlog_pick_list(backlog)
+            await query.message.reply_text(
+                message,
+                parse_mode=ParseMode.HTML,
+                reply_markup=build_backlog_pick_keyboard(backlog),
+            )
+        return
+
+    try:
+        item_id = int(data.split(":", 1)[1])
+    except ValueError:
+        await query.answer("Неверный номер задачи.", show_alert=True)
+        return
+
+    user_id = query.from_user.id
+    state = load_user_state(user_id)
+    backlog = get_backlog(state)
+    item = find_backlog_item(backlog, item_id)
+    if not item:
+        await query.answer("Задача не найдена в бэклоге.", show_alert=True)
+        return
+
+    if context.user_data.get("take_mode"):
         day = today_str()
         day_obj = get_day(state, day)
-        active_day = context.user_data.get("active_day")
-        if active_day and active_day != day:
-            await query.answer("Отмечать можно только в плане на сегодня.", show_alert=True)
-            return
         if day_obj.get("closed"):
-            await query.answer("Отмечать можно только в плане на сегодня.", show_alert=True)
+            context.user_data.pop("take_mode", None)
+            await query.answer()
+            await query.message.reply_text(
+                "Сегодня уже закрыт. Куда добавить задачу?",
+                reply_markup=build_pick_to_keyboard(item_id),
+            )
             return
 
-        context.user_data["view_scope"] = "day"
-        context.user_data["view_day"] = day
-        context.user_data["active_day"] = day
+        day_obj = add_task_to_day(state, day, item.get("text"))
+        drop_backlog_item(backlog, item)
+        save_user_state(user_id, state)
+        context.user_data.pop("take_mode", None)
+        show_day_view(context, day)
+        await query.answer("✅ Добавил в план на сегодня")
+        await query.message.reply_text(
+            render_plan(day, day_obj, show_hint=True),
+            parse_mode=ParseMode.HTML,
+            reply_markup=build_today_keyboard(day_obj),
+        )
+        return
 
-        ok, message = apply_done(day_obj, task_id)
-        if not ok:
-            await query.answer(message, show_alert=True)
-            return
+    context.user_data["move_task_id"] = item_id
+    pop_user_data(context, ("move_mode", "add_mode", "add_date", "del_mode", "awaiting_del_id", "take_mode"))
+    await query.answer()
+    await query.message.reply_text("Куда перенести задачу?", reply_markup=build_move_keyboard(item_id))
+
+
+async def cb_pick_to(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    ref = parse_callback_ref(data)
+    if ref is None:
+        await query.answer("Неверные данные.", show_alert=True)
+        return
+    target, item_id = ref
+    if item_id is None:
+        await query.answer("Неверный номер задачи.", show_alert=True)
+        return
+    user_id = query.from_user.id
+    state = load_user_state(user_id)
+    backlog = get_backlog(state)
+    item = find_backlog_item(backlog, item_id)
+    if not item:
+        await query.answer("Задача не найдена в бэклоге.", show_alert=True)
+        return
+    text = item.get("text")
+
+    if target == "tomorrow":
+        day = tomorrow_str()
+        day_obj = add_task_to_day(state, day, text)
+        drop_backlog_item(backlog, item)
+        save_user_state(user_id, state)
+        show_day_view(context, day)
+        await query.answer()
+        await query.message.reply_text(
+            f"✅ Добавил на {format_date_ru(day)}: {text}"
+        )
+        await query.message.reply_text(render_day_preview(day, day_obj, include_text=text))
+        return
 
+    if target == "reopen_today":
+        day = today_str()
+        day_obj = get_day(state, day)
+        day_obj["closed"] = False
+        day_obj.pop("closed_at", None)
+        if not day_obj.get("tasks"):
+            create_default_plan(day_obj)
+        day_obj = add_task_to_day(state, day, text)
+        drop_backlog_item(backlog, item)
         save_user_state(user_id, state)
-        await query.edit_message_text(
+        show_day_view(context, day)
+        await query.answer("✅ Добавил в план на сегодня")
+        await query.message.reply_text(
             render_plan(day, day_obj, show_hint=True),
             parse_mode=ParseMode.HTML,
             reply_markup=build_today_keyboard(day_obj),
         )
-        await query.answer(message)
         return
 
-    if data.startswith("add:"):
-        mode = data.split(":", 1)[1]
-        if mode not in {"today", "tomorrow", "date", "backlog", "reopen_today"}:
-            await query.answer("Неверный режим.", show_alert=True)
-            return
-
-        pending_text = context.user_data.pop("pending_add_text", None)
-
-        if mode in {"tomorrow", "reopen_today"} and pending_text:
-            user_id = query.from_user.id
-            state = load_user_state(user_id)
-            if mode == "reopen_today":
-                day = today_str()
-                day_obj = {"tasks": [], "closed": False, "created_at": now_iso()}
-                state.setdefault("days", {})[day] = day_obj
-                create_default_plan(day_obj)
-                day_obj = add_task_to_day(state, day, pending_text)
-                save_user_state(user_id, state)
-                context.user_data["view_scope"] = "day"
-                context.user_data["view_day"] = day
-                context.user_data["active_day"] = day
-                context.user_data.pop("awaiting_task_text", None)
-                await query.answer()
-                await query.message.reply_text(
-                    render_plan(day, day_obj, show_hint=True),
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=build_today_keyboard(day_obj),
-                )
-                return
-
-            day = tomorrow_str()
-            day_obj = add_task_to_day(state, day, pending_text)
-            save_user_state(user_id, state)
-            context.user_data["view_scope"] = "day"
-            context.user_data["view_day"] = day
-            context.user_data["active_day"] = day
-            context.user_data.pop("awaiting_task_text", None)
-            await query.answer()
-            await query.message.reply_text(
-                f"✅ Добавил задачу на {format_date_ru(day)}: {pending_text}"
-            )
-            await query.message.reply_text(render_day_preview(day, day_obj, include_text=pending_text))
-            return
-
-        if mode == "reopen_today":
-            context.user_data["add_mode"] = "reopen_today"
-            context.user_data.pop("add_date", None)
-            context.user_data["awaiting_task_text"] = True
-            await query.answer()
-            await query.message.reply_text(
-                "Напиши текст задачи одним сообщением.",
-                reply_markup=build_cancel_keyboard(),
-            )
-            return
 
-        context.user_data["add_mode"] = mode
-        context.user_data.pop("add_date", None)
-        context.user_data.pop("awaiting_task_text", None)
-        context.user_data.pop("del_mode", None)
-        context.user_data.pop("awaiting_del_id", None)
-        context.user_data.pop("move_mode", None)
-        context.user_data.pop("move_task_id", None)
+async def cb_move(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    if data == "move:cancel":
+        reset_input_modes(context)
+        await query.answer()
+        await query.message.reply_text("Ок, отменил.", reply_markup=build_start_keyboard())
+        return
+    if data == "move:back":
+        user_id = query.from_user.id
+        state = load_user_state(user_id)
+        backlog = get_backlog(state)
         await query.answer()
-        if mode == "date":
-            await query.message.reply_text(DATE_INPUT_ERROR, reply_markup=build_cancel_keyboard())
+        if not backlog:
+            await query.message.reply_text("📦 Бэклог пуст.")
         else:
-            context.user_data["awaiting_task_text"] = True
+            message = "Нажми на задачу, чтобы перенести в план или удалить."
+            message += "\n\n" + render_backlog_pick_list(backlog)
             await query.message.reply_text(
-                "Напиши текст задачи одним сообщением.",
-                reply_markup=build_cancel_keyboard(),
+                message,
+                parse_mode=ParseMode.HTML,
+                reply_markup=build_backlog_pick_keyboard(backlog),
             )
         return
 
-    if data.startswith("pick:"):
-        if data == "pick:back":
-            context.user_data.pop("move_mode", None)
-            context.user_data.pop("move_task_id", None)
-            context.user_data.pop("add_mode", None)
-            context.user_data.pop("add_date", None)
-            context.user_data.pop("del_mode", None)
-            context.user_data.pop("awaiting_del_id", None)
-            context.user_data.pop("take_mode", None)
-            user_id = query.from_user.id
-            state = load_user_state(user_id)
-            backlog = get_backlog(state)
-            await query.answer()
-            if not backlog:
-                await query.message.reply_text("📦 Бэклог пуст.")
-            else:
-                message = "Нажми на задачу, чтобы перенести в план или удалить."
-                message += "\n\n" + render_backlog_pick_list(backlog)
-                await query.message.reply_text(
-                    message,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=build_backlog_pick_keyboard(backlog),
-                )
-            return
+    ref = parse_move_ref(data)
+    if ref is None:
+        await query.answer("Неверные данные.", show_alert=True)
+        return
+    item_id, target = ref
+    if item_id is None:
+        await query.answer("Неверный номер задачи.", show_alert=True)
+        return
 
-        try:
-            item_id = int(data.split(":", 1)[1])
-        except ValueError:
-            await query.answer("Неверный номер задачи.", show_alert=True)
-            return
+    user_id = query.from_user.id
+    state = load_user_state(user_id)
 
-        user_id = query.from_user.id
-        state = load_user_state(user_id)
+    if target == "delete":
         backlog = get_backlog(state)
         item = find_backlog_item(backlog, item_id)
         if not item:
             await query.answer("Задача не найдена в бэклоге.", show_alert=True)
             return
-
-        if context.user_data.get("take_mode"):
-            day = today_str()
-            day_obj = get_day(state, day)
-            if day_obj.get("closed"):
-                context.user_data.pop("take_mode", None)
-                await query.answer()
-                await query.message.reply_text(
-                    "Сегодня уже закрыт. Куда добавить задачу?",
-                    reply_markup=build_pick_to_keyboard(item_id),
-                )
-                return
-
-            day_obj = add_task_to_day(state, day, item.get("text"))
-            backlog.remove(item)
-            backlog[:] = normalize_task_ids_backlog(backlog)
-            state["backlog"] = backlog
-            save_user_state(user_id, state)
-            context.user_data.pop("take_mode", None)
-            context.user_data["view_scope"] = "day"
-            context.user_data["view_day"] = day
-            context.user_data["active_day"] = day
-            await query.answer("✅ Добавил в план на сегодня")
+        drop_backlog_item(backlog, item)
+        save_user_state(user_id, state)
+        await query.answer("Удалил.")
+        if backlog:
+            message = "Нажми на задачу, чтобы перенести в план или удалить."
+            message += "\n\n" + render_backlog_pick_list(backlog)
             await query.message.reply_text(
-                render_plan(day, day_obj, show_hint=True),
+                message,
                 parse_mode=ParseMode.HTML,
-                reply_markup=build_today_keyboard(day_obj),
+                reply_markup=build_backlog_pick_keyboard(backlog),
             )
-            return
+        else:
+            await query.message.reply_text("📦 Бэклог пуст.")
+        return
 
+    if target == "date":
+        context.user_data["move_mode"] = "date"
         context.user_data["move_task_id"] = item_id
-        context.user_data.pop("move_mode", None)
-        context.user_data.pop("add_mode", None)
-        context.user_data.pop("add_date", None)
-        context.user_data.pop("del_mode", None)
-        context.user_data.pop("awaiting_del_id", None)
-        context.user_data.pop("take_mode", None)
+        pop_user_data(context, ("add_mode", "add_date", "del_mode", "awaiting_del_id"))
         await query.answer()
-        await query.message.reply_text("Куда перенести задачу?", reply_markup=build_move_keyboard(item_id))
+        await query.message.reply_text(DATE_INPUT_ERROR, reply_markup=build_cancel_keyboard())
         return
 
-    if data.startswith("pick_to:"):
-        parts = data.split(":")
-        if len(parts) != 3:
-            await query.answer("Неверные данные.", show_alert=True)
-            return
-
-        try:
-            item_id = int(parts[2])
-        except ValueError:
-            await query.answer("Неверный номер задачи.", show_alert=True)
-            return
+    if target not in {"today", "tomorrow"}:
+        await query.answer("Неверное направление.", show_alert=True)
+        return
 
-        target = parts[1]
-        user_id = query.from_user.id
-        state = load_user_state(user_id)
-        backlog = get_backlog(state)
-        item = find_backlog_item(backlog, item_id)
-        if not item:
-            await query.answer("Задача не найдена в бэклоге.", show_alert=True)
-            return
+    backlog = get_backlog(state)
+    item = find_backlog_item(backlog, item_id)
+    if not item:
+        await query.answer("Задача не найдена в бэклоге.", show_alert=True)
+        return
 
-        if target == "tomorrow":
-            day = tomorrow_str()
-            day_obj = add_task_to_day(state, day, item.get("text"))
-            backlog.remove(item)
-            backlog[:] = normalize_task_ids_backlog(backlog)
-            state["backlog"] = backlog
-            save_user_state(user_id, state)
-            context.user_data["view_scope"] = "day"
-            context.user_data["view_day"] = day
-            context.user_data["active_day"] = day
-            await query.answer()
-            await query.message.reply_text(
-                f"✅ Добавил на {format_date_ru(day)}: {item.get('text')}"
-            )
-            await query.message.reply_text(render_day_preview(day, day_obj, include_text=item.get("text")))
-            return
+    day = today_str() if target == "today" else tomorrow_str()
+    day_obj = get_day(state, day)
+    if target == "today" and day_obj.get("closed"):
+        await query.answer("День уже закрыт. Напиши /today чтобы открыть новый.", show_alert=True)
+        return
 
-        if target == "reopen_today":
-            day = today_str()
-            day_obj = get_day(state, day)
-            day_obj["closed"] = False
-            day_obj.pop("closed_at", None)
-            if not day_obj.get("tasks"):
-                create_default_plan(day_obj)
-            day_obj = add_task_to_day(state, day, item.get("text"))
-            backlog.remove(item)
-            backlog[:] = normalize_task_ids_backlog(backlog)
-            state["backlog"] = backlog
-            save_user_state(user_id, state)
-            context.user_data["view_scope"] = "day"
-            context.user_data["view_day"] = day
-            context.user_data["active_day"] = day
-            await query.answer("✅ Добавил в план на сегодня")
-            await query.message.reply_text(
+    text = item.get("text")
+    day_obj = add_task_to_day(state, day, text)
+    drop_backlog_item(backlog, item)
+    save_user_state(user_id, state)
+    context.user_data.pop("move_mode", None)
+    context.user_data.pop("move_task_id", None)
+    show_day_view(context, day)
+    if target == "today":
+        await asyncio.gather(
+            query.answer(),
+            query.message.reply_text(
                 render_plan(day, day_obj, show_hint=True),
                 parse_mode=ParseMode.HTML,
                 reply_markup=build_today_keyboard(day_obj),
-            )
-            return
-
-    if data.startswith("move:"):
-        parts = data.split(":")
-        if len(parts) == 2 and parts[1] == "cancel":
-            reset_input_modes(context)
-            await query.answer()
-            await query.message.reply_text("Ок, отменил.", reply_markup=build_start_keyboard())
-            return
-        if len(parts) == 2 and parts[1] == "back":
-            user_id = query.from_user.id
-            state = load_user_state(user_id)
-            backlog = get_backlog(state)
-            await query.answer()
-            if not backlog:
-                await query.message.reply_text("📦 Бэклог пуст.")
-            else:
-                message = "Нажми на задачу, чтобы перенести в план или удалить."
-                message += "\n\n" + render_backlog_pick_list(backlog)
-                await query.message.reply_text(
-                    message,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=build_backlog_pick_keyboard(backlog),
-                )
-            return
-
-        if len(parts) != 3:
-            await query.answer("Неверные данные.", show_alert=True)
-            return
-
-        try:
-            item_id = int(parts[1])
-        except ValueError:
-            await query.answer("Неверный номер задачи.", show_alert=True)
-            return
+            ),
+        )
+    else:
+        await asyncio.gather(
+            query.answer(),
+            query.message.reply_text(
+                f"✅ Перенёс на {format_date_ru(day)}: {text}"
+            ),
+        )
+        await query.message.reply_text(render_day_preview(day, day_obj, include_text=text))
 
-        target = parts[2]
-        user_id = query.from_user.id
-        state = load_user_state(user_id)
 
-        if target == "delete":
-            backlog = get_backlog(state)
-            item = find_backlog_item(backlog, item_id)
-            if not item:
-                await query.answer("Задача не найдена в бэклоге.", show_alert=True)
-                return
-            backlog.remove(item)
-            backlog[:] = normalize_task_ids_backlog(backlog)
-            state["backlog"] = backlog
-            save_user_state(user_id, state)
-            await query.answer("Удалил.")
-            if backlog:
-                message = "Нажми на задачу, чтобы перенести в план или удалить."
-                message += "\n\n" + render_backlog_pick_list(backlog)
-                await query.message.reply_text(
-                    message,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=build_backlog_pick_keyboard(backlog),
-                )
-            else:
-                await query.message.reply_text("📦 Бэклог пуст.")
-            return
+async def cb_backlog(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    ref = parse_callback_ref(data)
+    if ref is None:
+        await query.answer("Неверные данные.", show_alert=True)
+        return
+    action, item_id = ref
+    if item_id is None:
+        await query.answer("Неверный номер задачи.", show_alert=True)
+        return
 
-        if target == "date":
-            context.user_data["move_mode"] = "date"
-            context.user_data["move_task_id"] = item_id
-            context.user_data.pop("add_mode", None)
-            context.user_data.pop("add_date", None)
-            context.user_data.pop("del_mode", None)
-            context.user_data.pop("awaiting_del_id", None)
-            await query.answer()
-            await query.message.reply_text(DATE_INPUT_ERROR, reply_markup=build_cancel_keyboard())
-            return
+    user_id = query.from_user.id
+    state = load_user_state(user_id)
+    backlog = get_backlog(state)
+    item = find_backlog_item(backlog, item_id)
+    if not item:
+        await query.answer("Задача не найдена в бэклоге.", show_alert=True)
+        return
 
-        if target not in {"today", "tomorrow"}:
-            await query.answer("Неверное направление.", show_alert=True)
-            return
+    if action == "shorten":
+        context.user_data["backlog_edit"] = {"id": item_id, "action": "shorten"}
+        await query.answer("Жду новую формулировку.")
+        await query.message.reply_text("Напиши новую формулировку задачи.")
+        return
 
-        backlog = get_backlog(state)
-        item = find_backlog_item(backlog, item_id)
-        if not item:
-            await query.answer("Задача не найдена в бэклоге.", show_alert=True)
-            return
+    if action == "delete":
+        drop_backlog_item(backlog, item)
+        save_user_state(user_id, state)
+        await query.answer("Удалил из бэклога.")
+        await query.message.reply_text("🗑 Удалил из бэклога.")
+        return
 
-        day = today_str() if target == "today" else tomorrow_str()
+    if action == "return":
+        day = today_str()
         day_obj = get_day(state, day)
-        if target == "today" and day_obj.get("closed"):
+        if day_obj.get("closed"):
             await query.answer("День уже закрыт. Напиши /today чтобы открыть новый.", show_alert=True)
             return
 
-        day_obj = add_task_to_day(state, day, item.get("text"))
-        backlog.remove(item)
-        backlog[:] = normalize_task_ids_backlog(backlog)
-        state["backlog"] = backlog
+        tasks = day_obj.get("tasks", [])
+        text = item.get("text")
+        if not any(t.get("text") == text for t in tasks):
+            append_task(
+                day_obj,
+                {
+                    "text": text,
+                    "status": "todo",
+                    "created_at": item.get("created_at", now_iso()),
+                    "done_at": None,
+                    "carried_from": item.get("source_day"),
+                    "carry_count": int(item.get("carry_count", 0) or 0),
+                },
+            )
+
+        drop_backlog_item(backlog, item)
         save_user_state(user_id, state)
-        context.user_data.pop("move_mode", None)
-        context.user_data.pop("move_task_id", None)
-        context.user_data["view_scope"] = "day"
-        context.user_data["view_day"] = day
-        context.user_data["active_day"] = day
-        await query.answer()
-        if target == "today":
-            await query.message.reply_text(
+        show_day_view(context, day)
+        await asyncio.gather(
+            query.message.reply_text(
                 render_plan(day, day_obj, show_hint=True),
                 parse_mode=ParseMode.HTML,
                 reply_markup=build_today_keyboard(day_obj),
-            )
-        else:
-            await query.message.reply_text(
-                f"✅ Перенёс на {format_date_ru(day)}: {item.get('text')}"
-            )
-            await query.message.reply_text(render_day_preview(day, day_obj, include_text=item.get("text")))
+            ),
+            query.answer("Вернул в план на сегодня."),
+        )
         return
 
-    if data.startswith("backlog:"):
-        parts = data.split(":")
-        if len(parts) != 3:
-            await query.answer("Неверные данные.", show_alert=True)
-            return
+    await query.answer("Неизвестное действие.", show_alert=True)
 
-        action = parts[1]
-        try:
-            item_id = int(parts[2])
-        except ValueError:
-            await query.answer("Неверный номер задачи.", show_alert=True)
-            return
 
-        user_id = query.from_user.id
-        state = load_user_state(user_id)
-        backlog = get_backlog(state)
-        item = find_backlog_item(backlog, item_id)
-        if not item:
-            await query.answer("Задача не найдена в бэклоге.", show_alert=True)
-            return
+async def cb_evening(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, data: str) -> None:
+    user_id = query.from_user.id
+    state = load_user_state(user_id)
+    day = today_str()
+    if peek_day(state, day).get("closed"):
+        await asyncio.gather(
+            query.answer("День уже закрыт. Напиши /today чтобы увидеть план на сегодня.", show_alert=True),
+            query.message.reply_text("День уже закрыт. Напиши /today чтобы увидеть план на сегодня."),
+        )
+        return
 
-        if action == "shorten":
-            state["backlog_edit"] = {"id": item_id, "action": "shorten"}
-            save_user_state(user_id, state)
-            await query.answer("Жду новую формулировку.")
-            await query.message.reply_text("Напиши новую формулировку задачи.")
-            return
+    day_obj = get_day(state, day)
+    report = build_evening_report(state, day, day_obj)
+    save_user_state(user_id, state)
+    await asyncio.gather(
+        query.message.reply_text(report, parse_mode=ParseMode.HTML),
+        query.answer(),
+    )
 
-        if action == "delete":
-            backlog.remove(item)
-            backlog[:] = normalize_task_ids_backlog(backlog)
-            save_user_state(user_id, state)
-            await query.answer("Удалил из бэклога.")
-            await query.message.reply_text("🗑 Удалил из бэклога.")
-            return
 
-        if action == "return":
-            day = today_str()
-            day_obj = get_day(state, day)
-            if day_obj.get("closed"):
-                await query.answer("День уже закрыт. Напиши /today чтобы открыть новый.", show_alert=True)
-                return
+CallbackHandler = Callable[[CallbackQuery, ContextTypes.DEFAULT_TYPE, str], Awaitable[None]]
+
+# Ключ — точное значение callback_data или его префикс вместе с двоеточием
+CALLBACK_HANDLERS: Dict[str, CallbackHandler] = {
+    "cancel": cb_cancel,
+    "noop": cb_noop,
+    "fb:": cb_feedback,
+    "notif:": cb_notifications,
+    "del_pick_day:": cb_delete_pick_day,
+    "del_back": cb_delete_back,
+    "del_one:": cb_delete_one,
+    "triage:": cb_triage,
+    "triage_to:": cb_triage_to,
+    "hab:": cb_habits,
+    "habits_pick_day:": cb_habits,
+    "day:": cb_day,
+    "today:": cb_day,
+    "date:": cb_date,
+    "done:": cb_done,
+    "add:": cb_add,
+    "pick:": cb_pick,
+    "pick_to:": cb_pick_to,
+    "move:": cb_move,
+    "backlog:": cb_backlog,
+    "evening": cb_evening,
+}
 
-            tasks = day_obj.get("tasks", [])
-            task_texts = {t.get("text") for t in tasks}
-            if item.get("text") not in task_texts:
-                tasks.append(
-                    {
-                        "id": len(tasks) + 1,
-                        "text": item.get("text"),
-                        "status": "todo",
-                        "created_at": item.get("created_at", now_iso()),
-                        "done_at": None,
-                        "carried_from": item.get("source_day"),
-                        "carry_count": int(item.get("carry_count", 0) or 0),
-                    }
-                )
-                day_obj["tasks"] = normalize_task_ids(tasks)
-
-            backlog.remove(item)
-            backlog[:] = normalize_task_ids_backlog(backlog)
-            save_user_state(user_id, state)
-            context.user_data["view_scope"] = "day"
-            context.user_data["view_day"] = day
-            context.user_data["active_day"] = day
-            await query.message.reply_text(
-                render_plan(day, day_obj, show_hint=True),
-                parse_mode=ParseMode.HTML,
-                reply_markup=build_today_keyboard(day_obj),
-            )
-            await query.answer("Вернул в план на сегодня.")
-            return
 
-        await query.answer("Неизвестное действие.", show_alert=True)
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    if not query:
         return
 
-    if data == "evening":
-        user_id = query.from_user.id
-        state = load_user_state(user_id)
-        day = today_str()
-        day_obj = get_day(state, day)
-
-        if day_obj.get("closed"):
-            await query.answer("День уже закрыт. Напиши /today чтобы увидеть план на сегодня.", show_alert=True)
-            await query.message.reply_text("День уже закрыт. Напиши /today чтобы увидеть план на сегодня.")
-            return
-
-        report = build_evening_report(state, day, day_obj)
-        save_user_state(user_id, state)
-        await query.message.reply_text(report, parse_mode=ParseMode.HTML)
-        await query.answer()
+    data = query.data or ""
+    for old_prefix, new_prefix in CALLBACK_ALIASES.items():
+        if data.startswith(old_prefix):
+            data = new_prefix + data[len(old_prefix):]
+            break
+    prefix, sep, _ = data.partition(":")
+    handler = CALLBACK_HANDLERS.get(prefix + sep)
+    if handler:
+        await handler(query, context, data)
 
 
 def main() -> None:
@@ -2882,19 +3362,52 @@ def main() -> None:
     ensure_data_dir()
 
     request = HTTPXRequest(
+        connection_pool_size=BOT_API_POOL_SIZE,
+        connect_timeout=20,
+        read_timeout=30,
+        write_timeout=30,
+        pool_timeout=30,
+        http_version="2" if h2 is not None else "1.1",
+    )
+    # Long polling держит своё соединение и не занимает слоты пула для ответов
+    get_updates_request = HTTPXRequest(
         connect_timeout=20,
         read_timeout=30,
         write_timeout=30,
         pool_timeout=30,
     )
-    app = Application.builder().token(token).request(request).build()
-
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("today", cmd_today))
-    app.add_handler(CommandHandler("done", cmd_done))
-    app.add_handler(CommandHandler("evening", cmd_evening))
-    app.add_handler(CallbackQueryHandler(handle_callback))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_input))
+    app = (
+        Application.builder()
+        .token(token)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .concurrent_updates(True)
+        .post_init(start_save_flusher)
+        .post_shutdown(stop_save_flusher)
+        .build()
+    )
+
+    app.add_handler(CommandHandler("start", per_user_lock(cmd_start)))
+    app.add_handler(CommandHandler("today", per_user_lock(cmd_today)))
+    app.add_handler(CommandHandler("done", per_user_lock(cmd_done)))
+    app.add_handler(CommandHandler("evening", per_user_lock(cmd_evening)))
+    app.add_handler(CallbackQueryHandler(per_user_lock(handle_callback)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, per_user_lock(handle_text_input)))
+
+    webhook_url = os.getenv("WEBHOOK_URL", "").strip()
+    if webhook_url:
+        # Telegram сам присылает апдейты; без WEBHOOK_URL (локально) остаёмся на polling
+        url_path = secrets.token_urlsafe(24)
+        print("Bot is running (webhook)... Press Ctrl+C to stop.")
+        app.run_webhook(
+            listen=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+            port=int(os.getenv("PORT", "8443")),
+            url_path=url_path,
+            webhook_url=f"{webhook_url.rstrip('/')}/{url_path}",
+            secret_token=os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32),
+            close_loop=False,
+        )
+        return
 
     print("Bot is running... Press Ctrl+C to stop.")
     app.run_polling(close_loop=False)